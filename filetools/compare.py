@@ -3,28 +3,54 @@
 # import the necessary packages
 import numpy as np
 import cv2
+import mmap
 import os
+from typing import List
+
 try:
+    from scipy.ndimage import uniform_filter
     from skimage.metrics import structural_similarity
     has_skimage = True
 except ImportError:
     has_skimage = False
 
-__all__ = ["are_similar"]
+__all__ = ["are_similar", "difference_hash", "hamming_distances", "structural_similarity_pairs"]
+
+_reduced_grayscale_flags = {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                            8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+# number of set bits for every byte value, used to count differing hash bits
+_popcount = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
 
 
-def is_blurry(filename: str, threshold=100):
+def is_blurry(filename: str, threshold=100, cache=None):
+    if cache:
+        laplacian = cache.laplacian(filename)
+        return laplacian is not None and laplacian < threshold
     image = read_picture(filename)
     if image is None:
         return False
     return variance_of_laplacian(image) < threshold
 
 
-def are_similar(filenameA: str, filenameB: str, threshold=0.9):
+def blur_score(path: tuple, reduction=1, xscale=500):
+    # variance of laplacian of the picture, None if it can not be read
+    image = read_picture(path, xscale, reduction)
+    if image is None:
+        return None
+    return variance_of_laplacian(image)
+
+
+def are_similar(filenameA: str, filenameB: str, threshold=0.9, cache=None):
     if not has_skimage:
-        yield "no skimage installed"
-    imageA = read_picture(filenameA, 20)
-    imageB = read_picture(filenameB, 20)
+        print("no skimage installed")
+        return False
+    if cache:
+        imageA = cache.thumbnail(filenameA)
+        imageB = cache.thumbnail(filenameB)
+    else:
+        imageA = read_picture(filenameA, 20)
+        imageB = read_picture(filenameB, 20)
     if imageA is None or imageB is None:
         return False
     s = structural_similarity(imageA, imageB)
@@ -33,6 +59,56 @@ def are_similar(filenameA: str, filenameB: str, threshold=0.9):
     return threshold < s
 
 
+def structural_similarities(image_pairs: list) -> List[float]:
+    if not image_pairs:
+        return []
+    count = len(image_pairs)
+    stack = np.stack([imageA for imageA, imageB in image_pairs] + [imageB for imageA, imageB in image_pairs])
+    pairs = np.column_stack((np.arange(count), np.arange(count, 2 * count)))
+    return structural_similarity_pairs(stack, pairs).tolist()
+
+
+def structural_similarity_pairs(stack: np.ndarray, pairs, win_size=7, chunk_size=4096) -> np.ndarray:
+    """
+    mean structural similarity of stack[i] and stack[j] for every pair (i, j)
+    gives the same values as skimage structural_similarity with default parameters for uint8 images,
+    but filters the whole (N, height, width) stack at once instead of one pair per call
+    """
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    scores = np.empty(len(pairs))
+    images = stack.astype(np.float64)
+    sample_count = win_size ** 2
+    cov_norm = sample_count / (sample_count - 1)
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    pad = (win_size - 1) // 2
+
+    def local_mean(values):
+        return uniform_filter(values, size=(1, win_size, win_size))
+
+    means = local_mean(images)
+    variances = cov_norm * (local_mean(images * images) - means * means)
+    for start in range(0, len(pairs), chunk_size):
+        a, b = pairs[start:start + chunk_size].T
+        covariances = cov_norm * (local_mean(images[a] * images[b]) - means[a] * means[b])
+        similarity = ((2 * means[a] * means[b] + c1) * (2 * covariances + c2)) / (
+                (means[a] ** 2 + means[b] ** 2 + c1) * (variances[a] + variances[b] + c2))
+        scores[start:start + chunk_size] = similarity[:, pad:-pad, pad:-pad].mean(axis=(1, 2))
+    return scores
+
+
+def difference_hash(image) -> np.ndarray:
+    # 64 bit gradient hash: compare horizontally adjacent pixels of a 9x8 downscale
+    # returns the bits packed into 8 bytes, so hashes of many images stack to (N, 8)
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1])
+
+
+def hamming_distances(hashes: np.ndarray, image_hash: np.ndarray) -> np.ndarray:
+    # number of differing bits between image_hash and every row of hashes
+    return _popcount[np.bitwise_xor(hashes, image_hash)].sum(axis=1)
+
+
 def variance_of_laplacian(image):
     # compute the Laplacian of the image and then return the focus
     # measure, which is simply the variance of the Laplacian
@@ -65,11 +141,18 @@ def compare_images(directory, nameA, nameB):
     print("s", s)
 
 
-def read_picture(path: tuple, xscale=500):
+def read_picture(path: tuple, xscale=500, reduction=1):
+    """
+    reads a picture as xscale x xscale grayscale image
+    :param reduction:
+        2, 4 or 8 lets the jpeg decoder produce a grayscale image of 1/reduction size directly,
+        which is much faster and needs less memory than decoding the full resolution
+    """
+    if isinstance(path, str):
+        path = (path,)
     fullname = os.path.join(*path)
-    with open(fullname, 'rb') as img_stream:
-        file_bytes = np.asarray(bytearray(img_stream.read()), dtype=np.uint8)
-        picture = cv2.imdecode(file_bytes, cv2.IMREAD_UNCHANGED)
+    flags = _reduced_grayscale_flags.get(reduction, cv2.IMREAD_UNCHANGED)
+    picture = _decode_file(fullname, flags)
     if picture is None:
         print("failed to load", fullname)
         return
@@ -77,6 +160,20 @@ def read_picture(path: tuple, xscale=500):
         print("failed to load (data)", fullname)
         return
     picture = cv2.resize(picture, (xscale, xscale))
-    # convert the images to grayscale
-    picture = cv2.cvtColor(picture, cv2.COLOR_BGR2GRAY)
+    if flags == cv2.IMREAD_UNCHANGED:
+        # convert the images to grayscale
+        picture = cv2.cvtColor(picture, cv2.COLOR_BGR2GRAY)
+    return picture
+
+
+def _decode_file(fullname: str, flags: int):
+    # decode straight from a memory map instead of copying the file into a bytearray first
+    with open(fullname, 'rb') as img_stream:
+        if os.fstat(img_stream.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(img_stream.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+            file_bytes = np.frombuffer(file_map, dtype=np.uint8)
+            picture = cv2.imdecode(file_bytes, flags)
+            # the buffer has to be released before the map can be closed
+            del file_bytes
     return picture
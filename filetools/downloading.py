@@ -12,19 +12,31 @@ __email__ = "marco.volkert24@gmx.de"
 __status__ = "Development"
 
 import os
+import random
 import re
+import sqlite3
+import tempfile
+import threading
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from http.cookies import SimpleCookie
-from time import sleep
-from typing import List, Union, Tuple
+from time import monotonic, sleep
+from typing import Dict, List, Optional, Union, Tuple
+from urllib.parse import urlsplit
 from enum import Enum
-from filetools.helpers import read_file_as_bytes, isfile, modification_date
-from lxml import html
+from functools import lru_cache, partial
+from filetools.helpers import WorkerPool, read_file_as_bytes, isfile, modification_date
+from lxml import etree, html
 import requests
 from requests import Response
+from requests.adapters import HTTPAdapter
 
-__all__ = ["downloadFiles", "downloadFilesFromGallery", "downloadFilesMulti", "firstAndLazyLoaded", "NameSource"]
+download_chunk_size = 1024 * 1024
+
+__all__ = ["analyseLocalFiles", "downloadFiles", "downloadFilesFromGallery", "downloadFilesMulti", "firstAndLazyLoaded",
+           "NameSource"]
 
 
 class NameSource(Enum):
@@ -41,6 +53,8 @@ class HtmlResolver:
     dest_name: str = None
     dest_html: str = None
     last_date: datetime = datetime.now()
+    session: requests.Session = None
+    manifest: "DownloadManifest" = None
 
     def __init__(self, mainpage: str, name: str, sub_side: str = "", query="", pretty_print=False):
         self.http_path = _build_http_path(mainpage, sub_side, name, query)
@@ -71,22 +85,56 @@ class HtmlResolver:
     def get_file(self, url: str, dest: str, filename: str) -> bytes:
         raise Exception('not implemented')
 
+    def close(self):
+        if self.manifest:
+            self.manifest.close()
+        if self.session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ParsedPage:
+    """html page that is parsed once for all xpath expressions evaluated on it"""
+
+    def __init__(self, page: bytes):
+        self.tree = html.fromstring(page) if page else None
+
+    def xpath(self, xpath: str) -> list:
+        if self.tree is None or not xpath:
+            return []
+        return _compile_xpath(xpath)(self.tree)
+
+    def __bool__(self):
+        return self.tree is not None
 
-def get_hrefs(page: bytes, xpath='//a', contains='') -> List[str]:
+
+@lru_cache(maxsize=None)
+def _compile_xpath(xpath: str) -> etree.XPath:
+    return etree.XPath(xpath)
+
+
+def _parse(page: Union[bytes, ParsedPage]) -> ParsedPage:
+    return page if isinstance(page, ParsedPage) else ParsedPage(page)
+
+
+def get_hrefs(page: Union[bytes, ParsedPage], xpath='//a', contains='') -> List[str]:
     if not page:
         return []
-    tree = html.fromstring(page)
-    elements = tree.xpath(xpath)
+    elements = _parse(page).xpath(xpath)
     hrefs = [x.get("href") if x.get("href") else x.get("src") for x in elements]
     hrefs = [href for href in hrefs if href and contains in href]
     return hrefs
 
 
-def get_content(page: bytes, xpath: str) -> List[str]:
+def get_content(page: Union[bytes, ParsedPage], xpath: str) -> List[str]:
     if not page or not xpath:
         return []
-    tree = html.fromstring(page)
-    elements = tree.xpath(xpath)
+    elements = _parse(page).xpath(xpath)
     return [element.text_content() for element in elements]
 
 
@@ -94,85 +142,106 @@ def downloadFiles(mainpage: str, name: str, sub_side="", query="", g_xpath='//a'
                   f_contains="", g_part=-1, f_part=-1, ext="", cookies: Union[dict, str] = None, paginator="",
                   name_source: NameSource = NameSource.URL, start_after="", pretty_print=False, description_xpath='',
                   description_gallery_xpath='', tags_gallery_xpath='', gallery_overview_info_xpath='',
-                  statistic_only=False, analyse_local=False):
+                  statistic_only=False, analyse_local=False, max_parallel=4):
+    """
+    :param max_parallel:
+        number of files downloaded from one host at the same time, the gallery pages are still fetched in order
+    """
     if analyse_local:
         html_resolver = HtmlFileResolver(mainpage, name, sub_side, query=query, pretty_print=pretty_print)
     else:
         html_resolver = HtmlHttpResolver(mainpage, name, sub_side, query=query, pretty_print=pretty_print,
-                                         cookies=cookies)
-
-    # determine url of overview pages
-    urls = [html_resolver.http_path]
-    if paginator:
-        mainpage_content = html_resolver.get_mainpage()
-        pagination_hrefs = get_hrefs(mainpage_content, paginator)
-        for paginationHref in pagination_hrefs:
-            pagination_url = _createUrl(paginationHref, mainpage)
-            urls.append(pagination_url)
-
-    html_list = html_resolver.get_html_files(urls, html_resolver.dirname_name)
-
-    # extract galleries
-    galleries = []
-    gallery_overview_info = []
-    for html_page in html_list:
-        galleries += get_hrefs(html_page, g_xpath, g_contains)
-        if gallery_overview_info_xpath:
-            gallery_overview_info += get_content(html_page, gallery_overview_info_xpath)
-    if not galleries:
-        return
-    galleries = list(OrderedDict.fromkeys(galleries))
-    galleries.reverse()
-    gallery_overview_info.reverse()
-
-    html_title = get_content(html_list[0], r"//title")[0]
-    html_description = get_content(html_list[0], description_xpath)
-    _log_name(html_resolver, galleries, html_title, html_description)
-    found = False
-
-    for i, gallery in enumerate(galleries):
-        gallery_title = _strip_url(_extract_part(gallery, g_part))
-        if start_after and not found:
-            found = start_after == gallery_title
-            continue
-        dirname_gallery = '%03d_%s' % (i + 1, gallery_title)
-        gallery_url = _createUrl(gallery, mainpage)
-        html_list_gallery = html_resolver.get_html_files([gallery_url], dirname_gallery)
-        file_urls = get_hrefs(html_list_gallery[0], f_xpath, f_contains)
-
-        if len(file_urls) == 0:
-            print("no file urls found for ", dirname_gallery)
-            continue
-        elif len(file_urls) == 1 or name_source == NameSource.GALLERY:
-            dest_gallery = html_resolver.dest_name
-        else:
-            dest_gallery = os.path.join(html_resolver.dest_name, dirname_gallery)
-            if os.path.exists(dest_gallery):
+                                         cookies=cookies, use_manifest=not statistic_only)
+
+    with html_resolver:
+        # determine url of overview pages
+        urls = [html_resolver.http_path]
+        if paginator:
+            mainpage_content = html_resolver.get_mainpage()
+            pagination_hrefs = get_hrefs(mainpage_content, paginator)
+            for paginationHref in pagination_hrefs:
+                pagination_url = _createUrl(paginationHref, mainpage)
+                urls.append(pagination_url)
+
+        html_list = [ParsedPage(page) for page in html_resolver.get_html_files(urls, html_resolver.dirname_name)]
+
+        # extract galleries
+        galleries = []
+        gallery_overview_info = []
+        for html_page in html_list:
+            galleries += get_hrefs(html_page, g_xpath, g_contains)
+            if gallery_overview_info_xpath:
+                gallery_overview_info += get_content(html_page, gallery_overview_info_xpath)
+        if not galleries:
+            return
+        galleries = list(OrderedDict.fromkeys(galleries))
+        galleries.reverse()
+        gallery_overview_info.reverse()
+
+        html_title = get_content(html_list[0], r"//title")[0]
+        html_description = get_content(html_list[0], description_xpath)
+        _log_name(html_resolver, galleries, html_title, html_description)
+        found = False
+        manifest = html_resolver.manifest
+        downloads = _DownloadPool(max_parallel, manifest)
+        submitted_galleries = []
+
+        for i, gallery in enumerate(galleries):
+            gallery_title = _strip_url(_extract_part(gallery, g_part))
+            if start_after and not found:
+                found = start_after == gallery_title
+                continue
+            dirname_gallery = '%03d_%s' % (i + 1, gallery_title)
+            gallery_url = _createUrl(gallery, mainpage)
+            if manifest and manifest.is_gallery_complete(gallery_url):
                 continue
-            if not statistic_only:
-                os.makedirs(dest_gallery)
-        print(dest_gallery)
+            html_gallery = ParsedPage(html_resolver.get_html_files([gallery_url], dirname_gallery)[0])
+            file_urls = get_hrefs(html_gallery, f_xpath, f_contains)
 
-        for j, file_url in enumerate(file_urls):
-            file_url = _createUrl(file_url, mainpage)
-            filename = _build_file_name(file_urls, j, f_part, ext, html_resolver.dirname_name, i, gallery_title,
-                                        name_source)
-            if j == 0:
-                html_description_gallery = get_content(html_list_gallery[0], description_gallery_xpath)
-                html_tags_gallery = get_content(html_list_gallery[0], tags_gallery_xpath)
-                gallery_overview_info_entry = gallery_overview_info[i] if i < len(gallery_overview_info) else ''
-                _log_gallery(html_resolver, dirname_gallery, filename, file_urls, gallery,
-                             html_tags_gallery, html_description_gallery, gallery_overview_info_entry)
-            if not statistic_only:
-                download_file_direct(file_url, dest_gallery, filename, cookies=html_resolver.cookies,
-                                     headers={'Referer': gallery_url}, name_source=name_source)
+            if len(file_urls) == 0:
+                print("no file urls found for ", dirname_gallery)
+                continue
+            elif len(file_urls) == 1 or name_source == NameSource.GALLERY:
+                dest_gallery = html_resolver.dest_name
+            else:
+                dest_gallery = os.path.join(html_resolver.dest_name, dirname_gallery)
+                # galleries from before the manifest are only known by their directory
+                if os.path.exists(dest_gallery) and not (manifest and manifest.knows_gallery(gallery_url)):
+                    continue
+                if not statistic_only:
+                    os.makedirs(dest_gallery, exist_ok=True)
+            print(dest_gallery)
+
+            for j, file_url in enumerate(file_urls):
+                file_url = _createUrl(file_url, mainpage)
+                filename = _build_file_name(file_urls, j, f_part, ext, html_resolver.dirname_name, i, gallery_title,
+                                            name_source)
+                if j == 0:
+                    html_description_gallery = get_content(html_gallery, description_gallery_xpath)
+                    html_tags_gallery = get_content(html_gallery, tags_gallery_xpath)
+                    gallery_overview_info_entry = gallery_overview_info[i] if i < len(gallery_overview_info) else ''
+                    _log_gallery(html_resolver, dirname_gallery, filename, file_urls, gallery,
+                                 html_tags_gallery, html_description_gallery, gallery_overview_info_entry)
+                if manifest and manifest.is_complete(file_url):
+                    continue
+                if not statistic_only:
+                    downloads.submit(file_url, dest_gallery, filename, cookies=html_resolver.cookies,
+                                     headers={'Referer': gallery_url}, name_source=name_source,
+                                     session=html_resolver.session)
+            if manifest:
+                manifest.add_gallery(gallery_url)
+                submitted_galleries.append((gallery_url, [_createUrl(file_url, mainpage) for file_url in file_urls]))
+        downloads.wait()
+        if manifest:
+            for gallery_url, file_urls in submitted_galleries:
+                manifest.complete_gallery(gallery_url, file_urls)
 
 
 def downloadFilesMulti(mainpage: str, names: List[str], sub_side="", query="", g_xpath='//a', g_contains='',
                        f_xpath='//a', f_contains="", g_part=-1, f_part=-1, ext="", cookies: Union[dict, str] = None,
                        paginator="", name_source: NameSource = NameSource.URL, pretty_print=False, description_xpath='',
                        description_gallery_xpath='', tags_gallery_xpath='', gallery_overview_info_xpath='',
-                       statistic_only=False, analyse_local=False):
+                       statistic_only=False, analyse_local=False, max_parallel=4):
     names.sort()
     for name in names:
         downloadFiles(mainpage=mainpage, name=name, sub_side=sub_side, query=query,
@@ -181,7 +250,210 @@ def downloadFilesMulti(mainpage: str, names: List[str], sub_side="", query="", g
                       paginator=paginator, name_source=name_source, pretty_print=pretty_print,
                       description_xpath=description_xpath, description_gallery_xpath=description_gallery_xpath,
                       tags_gallery_xpath=tags_gallery_xpath, gallery_overview_info_xpath=gallery_overview_info_xpath,
-                      statistic_only=statistic_only, analyse_local=analyse_local)
+                      statistic_only=statistic_only, analyse_local=analyse_local, max_parallel=max_parallel)
+
+
+class _DownloadPool:
+    """downloads files on a thread pool with at most max_parallel downloads per host at the same time"""
+
+    def __init__(self, max_parallel=4, manifest: "DownloadManifest" = None):
+        self.max_parallel = max_parallel
+        self.manifest = manifest
+        # room for a second host, e.g. a content server next to the main page
+        self.executor = ThreadPoolExecutor(max_parallel * 2)
+        self.hosts: Dict[str, threading.Semaphore] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, url: str, dest: str, filename: str, **kwargs):
+        self.executor.submit(self._run, url, dest, filename, **kwargs)
+
+    def _run(self, url: str, dest: str, filename: str, **kwargs):
+        host = urlsplit(url).netloc
+        with self._lock:
+            semaphore = self.hosts.setdefault(host, threading.Semaphore(self.max_parallel))
+        with semaphore:
+            try:
+                response, path = download_file_direct(url, dest, filename, **kwargs)
+                if path and self.manifest:
+                    self.manifest.add_file(url, path, response)
+            except Exception as e:
+                print("download failed", url, e)
+
+    def wait(self):
+        self.executor.shutdown(wait=True)
+
+
+class DownloadManifest:
+    """
+    remembers downloaded files with their size and validators and the galleries that are complete,
+    so a crawl of a name again only fetches what is new
+    stored as downloadManifest.sqlite in the directory of the name
+    """
+    filename = "downloadManifest.sqlite"
+
+    def __init__(self, dest_name: str):
+        self.connection = sqlite3.connect(os.path.join(dest_name, self.filename), check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (url TEXT PRIMARY KEY, path TEXT, size INTEGER, "
+                                "etag TEXT, last_modified TEXT, complete INTEGER)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS galleries (url TEXT PRIMARY KEY, complete INTEGER)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        self._lock = threading.Lock()
+
+    def set_info(self, key: str, value: str):
+        with self._lock:
+            self.connection.execute("INSERT OR REPLACE INTO info VALUES (?, ?)", (key, value))
+            self.connection.commit()
+
+    def get_info(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self.connection.execute("SELECT value FROM info WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def add_file(self, url: str, path: str, response: Response, complete=True):
+        with self._lock:
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                    (url, path, os.path.getsize(path), response.headers.get('ETag'),
+                                     response.headers.get('Last-Modified'), complete))
+            self.connection.commit()
+
+    def is_complete(self, url: str) -> bool:
+        """downloaded completely and still the same size on disk"""
+        with self._lock:
+            row = self.connection.execute("SELECT path, size FROM files WHERE url = ? AND complete",
+                                          (url,)).fetchone()
+        return bool(row) and isfile(row[0]) and os.path.getsize(row[0]) == row[1]
+
+    def conditional_headers(self, url: str, path: str) -> dict:
+        """If-None-Match and If-Modified-Since for a page that is saved at path"""
+        with self._lock:
+            row = self.connection.execute("SELECT path, etag, last_modified FROM files WHERE url = ?",
+                                          (url,)).fetchone()
+        headers = {}
+        if not row or not row[0] == path or not isfile(path):
+            return headers
+        if row[1]:
+            headers['If-None-Match'] = row[1]
+        if row[2]:
+            headers['If-Modified-Since'] = row[2]
+        return headers
+
+    def add_gallery(self, url: str):
+        with self._lock:
+            self.connection.execute("INSERT OR IGNORE INTO galleries VALUES (?, 0)", (url,))
+            self.connection.commit()
+
+    def knows_gallery(self, url: str) -> bool:
+        with self._lock:
+            return bool(self.connection.execute("SELECT 1 FROM galleries WHERE url = ?", (url,)).fetchone())
+
+    def is_gallery_complete(self, url: str) -> bool:
+        with self._lock:
+            return bool(self.connection.execute("SELECT 1 FROM galleries WHERE url = ? AND complete",
+                                                (url,)).fetchone())
+
+    def complete_gallery(self, url: str, file_urls: List[str]):
+        """marks the gallery as complete if all of its files are"""
+        if all(self.is_complete(file_url) for file_url in file_urls):
+            with self._lock:
+                self.connection.execute("UPDATE galleries SET complete = 1 WHERE url = ?", (url,))
+                self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def analyseLocalFiles(mainpage: str, sub_side="", query="", g_xpath='//a', g_contains='', f_xpath='//a',
+                      f_contains="", g_part=-1, f_part=-1, ext="", paginator="",
+                      name_source: NameSource = NameSource.URL, description_xpath='', description_gallery_xpath='',
+                      tags_gallery_xpath='', gallery_overview_info_xpath='', workers: int = None):
+    """
+    rebuilds the rows of mainpage in download1_names.csv and download2_galleries.csv from the saved html pages
+    of all its names, the rows of other mainpages and of names that can not be analysed are kept
+    like downloadFiles with analyse_local and statistic_only, but for every directory in html at once
+    the names are analysed in parallel on a process pool, each csv file is written once at the end
+    :param workers:
+        number of processes, one per cpu if None
+    """
+    dirname_mainpage = _strip_url(mainpage)
+    html_dir = os.path.join(os.getcwd(), dirname_mainpage, 'html')
+    names_filename = os.path.join(os.getcwd(), _names_filename)
+    galleries_filename = os.path.join(os.getcwd(), _galleries_filename)
+    # the directories only have the (pretty printed) dirname, the url of the name comes from earlier runs
+    http_paths = {row[1]: row[3] for row in _read_rows(names_filename) if row[0] == dirname_mainpage and len(row) > 3}
+    names = sorted((entry.name, http_paths.get(entry.name)) for entry in os.scandir(html_dir) if entry.is_dir())
+    settings = dict(sub_side=sub_side, query=query, g_xpath=g_xpath, g_contains=g_contains, f_xpath=f_xpath,
+                    f_contains=f_contains, g_part=g_part, f_part=f_part, ext=ext, paginator=paginator,
+                    name_source=name_source, description_xpath=description_xpath,
+                    description_gallery_xpath=description_gallery_xpath, tags_gallery_xpath=tags_gallery_xpath,
+                    gallery_overview_info_xpath=gallery_overview_info_xpath)
+    with WorkerPool(workers) as pool:
+        results = pool.map(partial(_analyse_local_name, mainpage, **settings), names, chunksize=4)
+    failed = [name for (name, _), result in zip(names, results) if result is None]
+    name_rows = [name_row for name_row, gallery_rows in filter(None, results)]
+    gallery_rows = [row for name_row, gallery_rows in filter(None, results) for row in gallery_rows]
+    _rewrite_rows(names_filename, _names_header, dirname_mainpage, name_rows, failed)
+    _rewrite_rows(galleries_filename, _galleries_header, dirname_mainpage, gallery_rows, failed)
+    print("analysed %d names with %d galleries" % (len(name_rows), len(gallery_rows)))
+    if failed:
+        print("kept the previous rows of %d names that could not be analysed:" % len(failed), ", ".join(failed))
+
+
+def _analyse_local_name(mainpage: str, name_and_path: Tuple[str, Optional[str]], sub_side="", query="",
+                        g_xpath='//a', g_contains='', f_xpath='//a', f_contains="", g_part=-1, f_part=-1, ext="",
+                        paginator="",
+                        name_source: NameSource = NameSource.URL, description_xpath='', description_gallery_xpath='',
+                        tags_gallery_xpath='',
+                        gallery_overview_info_xpath='') -> Optional[Tuple[List[str], List[List[str]]]]:
+    # rows of one name for download1_names.csv and download2_galleries.csv, runs in a worker process
+    # None if the name can not be analysed, so its previous rows are kept
+    name, http_path = name_and_path
+    html_resolver = HtmlFileResolver(mainpage, name, sub_side, query=query)
+    manifest_path = os.path.join(html_resolver.dest_name, DownloadManifest.filename)
+    if isfile(manifest_path):
+        manifest = DownloadManifest(html_resolver.dest_name)
+        http_path = manifest.get_info("http_path") or http_path
+        manifest.close()
+    if http_path:
+        html_resolver.http_path = http_path
+    try:
+        urls = [html_resolver.http_path]
+        if paginator:
+            for pagination_href in get_hrefs(html_resolver.get_mainpage(), paginator):
+                urls.append(_createUrl(pagination_href, mainpage))
+        html_list = [ParsedPage(page) for page in html_resolver.get_html_files(urls, html_resolver.dirname_name)]
+        galleries = []
+        gallery_overview_info = []
+        for html_page in html_list:
+            galleries += get_hrefs(html_page, g_xpath, g_contains)
+            gallery_overview_info += get_content(html_page, gallery_overview_info_xpath)
+        if not galleries:
+            print("no galleries found for", name)
+            return None
+        galleries = list(OrderedDict.fromkeys(galleries))
+        galleries.reverse()
+        gallery_overview_info.reverse()
+        html_title = get_content(html_list[0], r"//title")[0]
+        name_row = _name_row(html_resolver, galleries, html_title, get_content(html_list[0], description_xpath))
+
+        gallery_rows = []
+        for i, gallery in enumerate(galleries):
+            gallery_title = _strip_url(_extract_part(gallery, g_part))
+            dirname_gallery = '%03d_%s' % (i + 1, gallery_title)
+            gallery_url = _createUrl(gallery, mainpage)
+            html_gallery = ParsedPage(html_resolver.get_html_files([gallery_url], dirname_gallery)[0])
+            file_urls = get_hrefs(html_gallery, f_xpath, f_contains)
+            if not file_urls:
+                continue
+            filename = _build_file_name(file_urls, 0, f_part, ext, html_resolver.dirname_name, i, gallery_title,
+                                        name_source)
+            gallery_rows.append(_gallery_row(html_resolver, dirname_gallery, filename, file_urls, gallery,
+                                             get_content(html_gallery, tags_gallery_xpath),
+                                             get_content(html_gallery, description_gallery_xpath),
+                                             gallery_overview_info[i] if i < len(gallery_overview_info) else ''))
+        return name_row, gallery_rows
+    except Exception as e:
+        print("can not analyse", name, e)
+        return None
 
 
 def downloadFilesFromGallery(mainpage: str, subpage: str, xpath='//a', contains="", part=-1, ext="",
@@ -195,80 +467,247 @@ def downloadFilesFromGallery(mainpage: str, subpage: str, xpath='//a', contains=
     os.makedirs(dest, exist_ok=True)
 
     gallery_url = _build_http_path(mainpage, subpage)
-    file_urls = get_hrefs(get_response_content(gallery_url, cookies=cookies), xpath, contains)
-    download_file_direct(gallery_url, dest, filename="%s.html" % subpage_dirname, cookies=cookies)
-    for file_url in file_urls:
-        file_url = _createUrl(file_url, mainpage)
-        downloadFile(file_url, dest, part=part, ext=ext, cookies=cookies, headers={'Referer': gallery_url}, name_source=name_source)
+    with _create_session(cookies) as session:
+        file_urls = get_hrefs(get_response_content(gallery_url, cookies=cookies, session=session), xpath, contains)
+        download_file_direct(gallery_url, dest, filename="%s.html" % subpage_dirname, cookies=cookies,
+                             session=session)
+        for file_url in file_urls:
+            file_url = _createUrl(file_url, mainpage)
+            downloadFile(file_url, dest, part=part, ext=ext, cookies=cookies, headers={'Referer': gallery_url},
+                         name_source=name_source, session=session)
 
 
 def firstAndLazyLoaded(mainpage: str, dirname: str, xpath='', contains="", cookies: dict = None):
     maindest = os.getcwd()
     dest = os.path.join(maindest, dirname)
     os.makedirs(dest, exist_ok=True)
-    file_urls = get_hrefs(get_response_content(mainpage, cookies=cookies), xpath, contains)
-    file_url = file_urls[0]
-    for i in range(0, 100):
-        contains_sub = contains.replace('0', i.__str__())
-        file_url_new = file_url.replace(contains, contains_sub)
-        try:
-            downloadFile(file_url_new, dest, cookies=cookies, headers={'Referer': mainpage})
-        except Exception:
-            break
+    with _create_session(cookies) as session:
+        file_urls = get_hrefs(get_response_content(mainpage, cookies=cookies, session=session), xpath, contains)
+        file_url = file_urls[0]
+        for i in range(0, 100):
+            contains_sub = contains.replace('0', i.__str__())
+            file_url_new = file_url.replace(contains, contains_sub)
+            try:
+                downloadFile(file_url_new, dest, cookies=cookies, headers={'Referer': mainpage}, session=session)
+            except Exception:
+                break
 
 
 def downloadFile(url: str, dest: str, filename="", part=-1, ext="", cookies: dict = None, headers: dict = None,
-                 do_throw=False, name_source: NameSource = NameSource.URL) -> Tuple[Response, str]:
+                 do_throw=False, name_source: NameSource = NameSource.URL,
+                 session: requests.Session = None) -> Tuple[Response, str]:
     print(filename)
     if not filename:
         filename = _build_file_name([url], 0, part=part, ext=ext)
     url = _strip_options(url)
-    return download_file_direct(url, dest, filename, cookies, headers, do_throw, name_source)
+    return download_file_direct(url, dest, filename, cookies, headers, do_throw, name_source, session)
 
 
 def download_file_direct(url: str, dest: str, filename: str, cookies: dict = None, headers: dict = None,
-                         do_throw=False, name_source: NameSource = NameSource.URL) -> Tuple[Response, str]:
-    response = get_response(url, cookies, headers, do_throw)
-    if response.status_code != 200:
-        return response, ""
-    if name_source == NameSource.CONTENT:
-        response_filename = _extract_filename_from_response(response)
-        if response_filename:
-            filename = response_filename
-    filepath = os.path.join(dest, filename)
-    with open(filepath, 'wb') as f:
-        f.write(response.content)
+                         do_throw=False, name_source: NameSource = NameSource.URL,
+                         session: requests.Session = None) -> Tuple[Response, str]:
+    """
+    streams the file to <filename>.part and renames it when complete
+    a part file left by an interrupted run is continued with a range request
+    the content is not kept in the response, read it from the returned path
+    """
+    part_path = os.path.join(dest, filename + ".part")
+    request_headers = dict(headers) if headers else {}
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if offset:
+        request_headers['Range'] = 'bytes=%d-' % offset
+    response = get_response(url, cookies, request_headers, do_throw, session, stream=True)
+    with response:
+        resumed = response.status_code == 206 and response.headers.get('Content-Range', '').startswith(
+            'bytes %d-' % offset)
+        if offset and response.status_code == 416 and response.headers.get('Content-Range') == 'bytes */%d' % offset:
+            # the part file is already complete, the previous run stopped before renaming it
+            filepath = os.path.join(dest, filename)
+            print("already complete: " + filepath)
+            response.close()
+            os.replace(part_path, filepath)
+            return response, filepath
+        if offset and (response.status_code == 416 or response.status_code == 206 and not resumed):
+            # part file is not a prefix of the current file anymore or the range was not served as requested
+            print("restart: " + os.path.join(dest, filename))
+            response.close()
+            os.remove(part_path)
+            return download_file_direct(url, dest, filename, cookies, headers, do_throw, name_source, session)
+        if response.status_code not in (200, 206):
+            return response, ""
+        if name_source == NameSource.CONTENT:
+            response_filename = _extract_filename_from_response(response)
+            if response_filename:
+                filename = response_filename
+        filepath = os.path.join(dest, filename)
+        if offset:
+            print("resume at %d bytes: %s" % (offset, filepath) if resumed else "restart: " + filepath)
+        with open(part_path, 'ab' if resumed else 'wb') as f:
+            for chunk in response.iter_content(chunk_size=download_chunk_size):
+                f.write(chunk)
+    os.replace(part_path, filepath)
     return response, filepath
 
 
-def get_response_content(url: str, cookies: dict = None, headers: dict = None, do_throw=False) -> bytes:
-    response = get_response(url, cookies, headers, do_throw)
+def get_response_content(url: str, cookies: dict = None, headers: dict = None, do_throw=False,
+                         session: requests.Session = None) -> bytes:
+    response = get_response(url, cookies, headers, do_throw, session)
     if response.status_code != 200:
         print('bad response: ', response)
         return b''
     return response.content
 
 
-def get_response(url: str, cookies: dict = None, headers: dict = None, do_throw=False) -> Response:
+def get_response(url: str, cookies: dict = None, headers: dict = None, do_throw=False,
+                 session: requests.Session = None, stream=False, retries=5) -> Response:
+    """
+    requests to one host are paced by the shared rate_limiter
+    connection errors, 429 and 503 are retried with exponential backoff or after Retry-After
+    :param session:
+        reuses its pooled connections, without a session every request opens a new connection
+    :param stream:
+        do not load the content, it has to be read with iter_content and the response closed
+    :param retries:
+        number of retries before the error is raised or returned
+    """
     if cookies is None:
         cookies = {}
     if headers is None:
         headers = {}
     headers['Connection'] = 'keep-alive'
+    get = session.get if session else requests.get
+    host = urlsplit(url).netloc
     print("get: " + url)
-    try:
-        response = requests.get(url, cookies=cookies, headers=headers)
-    except (requests.exceptions.ConnectionError, OSError) as e:
-        print("got exception maybe to many requests - try again", e)
-        sleep(30)
-        response = requests.get(url, cookies=cookies, headers=headers)
-    if response.status_code != 200:
+    for attempt in range(retries + 1):
+        rate_limiter.acquire(host)
+        try:
+            response = get(url, cookies=cookies, headers=headers, stream=stream)
+        except (requests.exceptions.ConnectionError, OSError) as e:
+            if attempt == retries:
+                raise
+            rate_limiter.throttled(host)
+            delay = _backoff(attempt)
+            print("got exception maybe to many requests - try again in %.1fs" % delay, e)
+            sleep(delay)
+            continue
+        if response.status_code not in (429, 503) or attempt == retries:
+            break
+        retry_after = _retry_after(response)
+        rate_limiter.throttled(host, retry_after)
+        response.close()
+        if retry_after is None:
+            delay = _backoff(attempt)
+            print("got %d - try again in %.1fs" % (response.status_code, delay))
+            sleep(delay)
+        else:
+            print("got %d - try again after %.1fs" % (response.status_code, retry_after))
+    if response.status_code not in (429, 503):
+        rate_limiter.succeeded(host)
+    if response.status_code not in (200, 206, 304):
         print("error in get " + url + " : " + str(response.status_code) + "" + response.reason)
         if do_throw:
             raise Exception
     return response
 
 
+class HostRateLimiter:
+    """
+    token bucket per host whose rate adapts to the responses:
+    it grows additively with every success and is halved when the host throttles (AIMD)
+    thread safe, so concurrent downloads share the limit of a host
+    """
+
+    def __init__(self, rate=4.0, burst=8, min_rate=0.2, max_rate=50.0, increase=0.1):
+        """
+        :param rate:
+            initial requests per second of a host
+        :param burst:
+            number of requests that can be sent at once after a pause
+        """
+        self.initial_rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.hosts: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def _host(self, host: str) -> dict:
+        if host not in self.hosts:
+            self.hosts[host] = {"rate": self.initial_rate, "tokens": float(self.burst), "time": monotonic(),
+                                "blocked_until": 0.0}
+        return self.hosts[host]
+
+    def acquire(self, host: str):
+        """waits until a request to the host is allowed"""
+        while True:
+            with self._lock:
+                state = self._host(host)
+                now = monotonic()
+                state["tokens"] = min(self.burst, state["tokens"] + (now - state["time"]) * state["rate"])
+                state["time"] = now
+                if now < state["blocked_until"]:
+                    wait = state["blocked_until"] - now
+                elif state["tokens"] >= 1:
+                    state["tokens"] -= 1
+                    return
+                else:
+                    wait = (1 - state["tokens"]) / state["rate"]
+            sleep(wait)
+
+    def succeeded(self, host: str):
+        with self._lock:
+            state = self._host(host)
+            state["rate"] = min(self.max_rate, state["rate"] + self.increase)
+
+    def throttled(self, host: str, retry_after: float = None):
+        """
+        :param retry_after:
+            no request is sent to the host for this many seconds
+        """
+        with self._lock:
+            state = self._host(host)
+            state["rate"] = max(self.min_rate, state["rate"] / 2)
+            state["tokens"] = min(state["tokens"], 0.0)
+            if retry_after:
+                state["blocked_until"] = max(state["blocked_until"], monotonic() + retry_after)
+
+
+rate_limiter = HostRateLimiter()
+
+
+def _backoff(attempt: int, base=2.0, cap=120.0) -> float:
+    # exponential backoff with jitter, so retrying workers do not hit the host at the same time
+    return random.uniform(base, min(cap, base * 2 ** (attempt + 1)))
+
+
+def _retry_after(response: Response) -> Optional[float]:
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (date - datetime.now(date.tzinfo)).total_seconds())
+
+
+def _create_session(cookies: dict = None, headers: dict = None, pool_maxsize=16) -> requests.Session:
+    """session with a connection pool per host, so galleries of many small files do not pay a handshake each"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    if headers:
+        session.headers.update(headers)
+    if cookies:
+        session.cookies.update(cookies)
+    return session
+
+
 def _strip_url(url: str) -> str:
     replacements = ['http://', 'https://', 'www.', '.com', '.de', '.html']
     name = _strip_options(url)
@@ -353,36 +792,72 @@ def _cookie_string_2_dict(cookie_string: str) -> dict:
     return cookies
 
 
+_names_filename = "download1_names.csv"
+_names_header = ["dirname_mainpage", "dirname_name", "number-of-galleries", "download-source-name", "download-title",
+                 "download-description", "download-date"]
+_galleries_filename = "download2_galleries.csv"
+_galleries_header = ["dirname_mainpage", "dirname_name", "dirname_gallery", "filename", "number-of-files",
+                     "download-source-gallery", "download-date", "html_tags", "html_description", "overview_info"]
+
+
 def _log_name(html_resolver: HtmlResolver, galleries: List[str],
               html_title: str,
               html_description: List[str]):
-    ofilename = os.path.join(html_resolver.dest_main, "download1_names.csv")
-    ofile_exists = os.path.isfile(ofilename)
-    with open(ofilename, 'a') as ofile:
-        if not ofile_exists:
-            ofile.write(";".join(
-                ["dirname_mainpage", "dirname_name", "number-of-galleries", "download-source-name", "download-title",
-                 "download-description", "download-date"]) + "\n")
-        ofile.write(";".join(
-            [html_resolver.dirname_mainpage, html_resolver.dirname_name, str(len(galleries)), html_resolver.http_path,
-             html_title, ", ".join(html_description),
-             str(html_resolver.last_date)]) + "\n")
+    _append_rows(os.path.join(html_resolver.dest_main, _names_filename), _names_header,
+                 [_name_row(html_resolver, galleries, html_title, html_description)])
 
 
 def _log_gallery(html_resolver: HtmlResolver, dirname_gallery: str, filename: str,
                  file_urls: List[str], gallery: str, html_tags: List[str], html_description: List[str],
                  overview_info=""):
-    ofilename = os.path.join(html_resolver.dest_main, "download2_galleries.csv")
-    ofile_exists = os.path.isfile(ofilename)
+    _append_rows(os.path.join(html_resolver.dest_main, _galleries_filename), _galleries_header,
+                 [_gallery_row(html_resolver, dirname_gallery, filename, file_urls, gallery, html_tags,
+                               html_description, overview_info)])
+
+
+def _name_row(html_resolver: HtmlResolver, galleries: List[str], html_title: str,
+              html_description: List[str]) -> List[str]:
+    return [html_resolver.dirname_mainpage, html_resolver.dirname_name, str(len(galleries)), html_resolver.http_path,
+            html_title, ", ".join(html_description), str(html_resolver.last_date)]
+
+
+def _gallery_row(html_resolver: HtmlResolver, dirname_gallery: str, filename: str, file_urls: List[str],
+                 gallery: str, html_tags: List[str], html_description: List[str], overview_info="") -> List[str]:
+    return [html_resolver.dirname_mainpage, html_resolver.dirname_name, dirname_gallery, filename, str(len(file_urls)),
+            gallery, str(html_resolver.last_date), ", ".join(html_tags), ", ".join(html_description), overview_info]
+
+
+def _read_rows(ofilename: str) -> List[List[str]]:
+    if not os.path.isfile(ofilename):
+        return []
+    with open(ofilename, 'r') as ofile:
+        return [line.rstrip("\n").split(";") for line in ofile][1:]
+
+
+def _rewrite_rows(ofilename: str, header: List[str], dirname_mainpage: str, rows: List[List[str]],
+                  keep_names: List[str] = ()):
+    # replaces the rows of one mainpage, the rows of other mainpages and of the keep_names of this one are kept
+    if os.path.isfile(ofilename):
+        with open(ofilename, 'r') as ofile:
+            kept = [line for line in list(ofile)[1:] if not line.split(";", 1)[0] == dirname_mainpage or
+                    line.split(";", 2)[1] in keep_names]
+    else:
+        kept = []
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(ofilename), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as ofile:
+            ofile.write("".join([";".join(header) + "\n"] + kept + [";".join(row) + "\n" for row in rows]))
+        os.replace(tmp_filename, ofilename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+def _append_rows(ofilename: str, header: List[str], rows: List[List[str]]):
+    lines = [] if os.path.isfile(ofilename) else [";".join(header) + "\n"]
+    lines += [";".join(row) + "\n" for row in rows]
     with open(ofilename, 'a') as ofile:
-        if not ofile_exists:
-            ofile.write(";".join(
-                ["dirname_mainpage", "dirname_name", "dirname_gallery", "filename", "number-of-files",
-                 "download-source-gallery", "download-date", "html_tags", "html_description", "overview_info"]) + "\n")
-        ofile.write(";".join(
-            [html_resolver.dirname_mainpage, html_resolver.dirname_name, dirname_gallery, filename, str(len(file_urls)),
-             gallery, str(html_resolver.last_date),
-             ", ".join(html_tags), ", ".join(html_description), overview_info]) + "\n")
+        ofile.write("".join(lines))
 
 
 def pretty_name(name: str) -> str:
@@ -400,12 +875,21 @@ class HtmlHttpResolver(HtmlResolver):
     headers: dict = None
 
     def __init__(self, mainpage: str, name: str, sub_side: str = "", query="", pretty_print=False,
-                 cookies: Union[dict, str] = None, headers: dict = None):
+                 cookies: Union[dict, str] = None, headers: dict = None, use_manifest=True):
+        """
+        :param use_manifest:
+            skip unchanged pages and completed files with the download manifest of the name and record new ones
+        """
         super().__init__(mainpage, name, sub_side, query, pretty_print=pretty_print)
         self._set_cookies(cookies)
         self._set_headers(headers)
+        self.session = _create_session(self.cookies, self.headers)
         os.makedirs(self.dest_name, exist_ok=True)
         os.makedirs(self.dest_html, exist_ok=True)
+        if use_manifest:
+            self.manifest = DownloadManifest(self.dest_name)
+            # the directory name may be pretty printed, analyseLocalFiles needs the original url
+            self.manifest.set_info("http_path", self.http_path)
 
     def _set_cookies(self, cookies):
         if cookies:
@@ -430,15 +914,26 @@ class HtmlHttpResolver(HtmlResolver):
 
     def get_mainpage(self) -> bytes:
         self.last_date = datetime.now()
-        return get_response_content(self.http_path, cookies=self.cookies, headers=self.headers)
+        return get_response_content(self.http_path, cookies=self.cookies, headers=self.headers, session=self.session)
 
     def get_file(self, url: str, dest: str, filename: str) -> bytes:
+        """fetches the page only if it changed since it was saved, using conditional requests"""
         self.last_date = datetime.now()
-        response, path = download_file_direct(url, dest, filename, cookies=self.cookies, headers=self.headers)
-        if response.status_code != 200:
+        filepath = os.path.join(dest, filename)
+        headers = dict(self.headers)
+        if self.manifest:
+            headers.update(self.manifest.conditional_headers(url, filepath))
+        response, path = download_file_direct(url, dest, filename, cookies=self.cookies, headers=headers,
+                                              session=self.session)
+        if response.status_code == 304:
+            print("not modified: " + url)
+            return read_file_as_bytes(filepath)
+        if not path:
             print('bad response: ', response)
             return b''
-        return response.content
+        if self.manifest:
+            self.manifest.add_file(url, path, response)
+        return read_file_as_bytes(path)
 
 
 class HtmlFileResolver(HtmlResolver):
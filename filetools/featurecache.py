@@ -0,0 +1,188 @@
+"""
+cache of picture features (thumbnail, difference hash, laplacian variance)
+
+features are kept in memory for the current run and optionally persisted to a sqlite file
+in every scanned directory. Entries are keyed by filename, size and modification time,
+so only new or changed pictures have to be decoded again.
+"""
+
+import os
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .compare import read_picture, difference_hash, variance_of_laplacian
+from .helpers import WorkerPool
+
+__all__ = ["FeatureCache"]
+
+
+class FeatureCache:
+    filename = "featureCache.sqlite"
+    thumbnail_size = 20
+    thumbnail_reduction = 8
+    laplacian_size = 500
+    commit_interval = 100
+
+    def __init__(self, persistent=True, keep_in_memory=True):
+        """
+        :param persistent:
+            store features in a sqlite file per directory and reuse them in later runs
+        :param keep_in_memory:
+            keep features of the current run in memory, so a picture is decoded at most once
+        """
+        self.persistent = persistent
+        self.keep_in_memory = keep_in_memory
+        self._connections: Dict[str, Optional[sqlite3.Connection]] = {}
+        self._uncommitted: Dict[str, int] = {}
+        self._memory: Dict[Tuple[str, str], dict] = {}
+
+    def thumbnail(self, path: tuple) -> Optional[np.ndarray]:
+        return self._features(path, "thumbnail")["thumbnail"]
+
+    def hash(self, path: tuple) -> Optional[np.ndarray]:
+        return self._features(path, "thumbnail")["hash"]
+
+    def laplacian(self, path: tuple) -> Optional[float]:
+        return self._features(path, "laplacian")["laplacian"]
+
+    def prefetch(self, paths: List[tuple], feature="thumbnail", pool: WorkerPool = None):
+        """
+        decode all pictures whose feature is not cached yet, in parallel if a pool is given
+        without keep_in_memory the prefetched features are kept until they are read once
+        """
+        # the same picture may be passed more than once, for example as both sides of a comparison
+        keys = list(dict.fromkeys(_split(path) for path in paths))
+        missing = []
+        for key in keys:
+            features = self._memory.get(key)
+            if features is None:
+                features = self._load(*key)
+                self._memory[key] = features
+            if feature not in features:
+                missing.append(key)
+        if not missing:
+            return
+        read = _read_thumbnail if feature == "thumbnail" else _read_laplacian
+        results = pool.map(read, missing, chunksize=16) if pool else [read(key) for key in missing]
+        for key, result in zip(missing, results):
+            self._memory[key].update(result)
+            self._store(*key, self._memory[key])
+
+    def evict(self, path: tuple):
+        """forget a file, for example after it was moved or renamed"""
+        dirpath, filename = _split(path)
+        self._memory.pop((dirpath, filename), None)
+        connection = self._connection(dirpath)
+        if connection:
+            connection.execute("DELETE FROM features WHERE filename = ?", (filename,))
+            self._written(dirpath)
+
+    def close(self):
+        for connection in self._connections.values():
+            if connection:
+                connection.commit()
+                connection.close()
+        self._connections = {}
+        self._uncommitted = {}
+        self._memory = {}
+
+    def _features(self, path: tuple, feature: str) -> dict:
+        dirpath, filename = _split(path)
+        key = (dirpath, filename)
+        features = self._memory.get(key)
+        if features is None:
+            features = self._load(dirpath, filename)
+        if feature == "thumbnail" and "thumbnail" not in features:
+            features.update(_read_thumbnail(key))
+            self._store(dirpath, filename, features)
+        if feature == "laplacian" and "laplacian" not in features:
+            features.update(_read_laplacian(key))
+            self._store(dirpath, filename, features)
+        if self.keep_in_memory:
+            self._memory[key] = features
+        else:
+            self._memory.pop(key, None)
+        return features
+
+    def _load(self, dirpath: str, filename: str) -> dict:
+        stats = os.stat(os.path.join(dirpath, filename))
+        features = {"size": stats.st_size, "mtime": stats.st_mtime_ns}
+        connection = self._connection(dirpath)
+        if not connection:
+            return features
+        row = connection.execute("SELECT size, mtime, thumbnail, hash, laplacian FROM features WHERE filename = ?",
+                                 (filename,)).fetchone()
+        if not row or row[0] != features["size"] or row[1] != features["mtime"]:
+            return features
+        thumbnail, image_hash, laplacian = row[2:]
+        if thumbnail is not None and len(thumbnail) == self.thumbnail_size ** 2:
+            features["thumbnail"] = np.frombuffer(thumbnail, dtype=np.uint8).reshape(
+                (self.thumbnail_size, self.thumbnail_size))
+            features["hash"] = np.frombuffer(image_hash, dtype=np.uint8)
+        if laplacian is not None:
+            features["laplacian"] = laplacian
+        return features
+
+    def _store(self, dirpath: str, filename: str, features: dict):
+        connection = self._connection(dirpath)
+        if not connection:
+            return
+        thumbnail = features.get("thumbnail")
+        image_hash = features.get("hash")
+        connection.execute("INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?)",
+                           (filename, features["size"], features["mtime"],
+                            None if thumbnail is None else thumbnail.tobytes(),
+                            None if image_hash is None else image_hash.tobytes(),
+                            features.get("laplacian")))
+        self._written(dirpath)
+
+    def _written(self, dirpath: str):
+        self._uncommitted[dirpath] = self._uncommitted.get(dirpath, 0) + 1
+        if self._uncommitted[dirpath] >= self.commit_interval:
+            self._connections[dirpath].commit()
+            self._uncommitted[dirpath] = 0
+
+    def _connection(self, dirpath: str) -> Optional[sqlite3.Connection]:
+        if not self.persistent:
+            return None
+        if dirpath in self._connections:
+            return self._connections[dirpath]
+        try:
+            connection = sqlite3.connect(os.path.join(dirpath, self.filename))
+            connection.execute("CREATE TABLE IF NOT EXISTS features (filename TEXT PRIMARY KEY, size INTEGER, "
+                               "mtime INTEGER, thumbnail BLOB, hash BLOB, laplacian REAL)")
+        except sqlite3.Error as e:
+            print("feature cache not available for", dirpath, e)
+            connection = None
+        self._connections[dirpath] = connection
+        if connection:
+            self._evict_missing(dirpath, connection)
+        return connection
+
+    @staticmethod
+    def _evict_missing(dirpath: str, connection: sqlite3.Connection):
+        # files that were renamed or moved away since the last run
+        existing = set(os.listdir(dirpath))
+        cached = [row[0] for row in connection.execute("SELECT filename FROM features")]
+        missing = [(filename,) for filename in cached if filename not in existing]
+        if missing:
+            connection.executemany("DELETE FROM features WHERE filename = ?", missing)
+            connection.commit()
+
+
+def _read_thumbnail(path: tuple) -> dict:
+    thumbnail = read_picture(path, FeatureCache.thumbnail_size, FeatureCache.thumbnail_reduction)
+    return {"thumbnail": thumbnail, "hash": None if thumbnail is None else difference_hash(thumbnail)}
+
+
+def _read_laplacian(path: tuple) -> dict:
+    picture = read_picture(path, FeatureCache.laplacian_size)
+    return {"laplacian": None if picture is None else variance_of_laplacian(picture)}
+
+
+def _split(path: tuple) -> Tuple[str, str]:
+    if isinstance(path, str):
+        return os.path.split(path)
+    return os.path.split(os.path.join(*path))
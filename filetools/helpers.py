@@ -1,7 +1,8 @@
 import datetime
 import os
 import re
-from typing import List, Iterable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, List, Iterable, NamedTuple
 
 from natsort import natsorted
 
@@ -69,19 +70,80 @@ def moveToSubpath(filename, dirpath, subpath):
 
 
 def getFileNamesOfMainDir(path):
-    for (dirpath, dirnames, filenames) in os.walk(path):
-        return [filename for filename in filenames if ".jpg" in filename]
+    return [entry.name for entry in walk_entries(path, [".jpg"], max_depth=0, with_stat=False)]
 
 
 def getFileNamesOfMainDir2(path, subpath=True) -> List[str]:
-    out_filenames = []
-    for (dirpath, dirnames, filenames) in os.walk(path):
-        if not subpath and not dirpath == path: break
-        out_filenames.extend([(dirpath, filename) for filename in filenames if ".jpg" in filename])
+    out_filenames = [(entry.dirpath, entry.name) for entry in
+                     walk_entries(path, [".jpg"], max_depth=None if subpath else 0, with_stat=False)]
     out_filenames = natsorted(out_filenames, key=lambda x: x[1])
     return out_filenames
 
 
+class FileEntry(NamedTuple):
+    dirpath: str
+    name: str
+    is_dir: bool
+    size: int
+    mtime: float
+    depth: int
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.dirpath, self.name)
+
+
+def walk_entries(top: str, extensions: Iterable = None, max_depth: int = None, with_stat=True, include_dirs=False,
+                 skip_dirs: Iterable = (), follow_symlinks=False, include_links=True) -> Iterable[FileEntry]:
+    """
+    walks top down through a tree like os.walk, but with os.scandir and without extra syscalls per entry
+    :param extensions:
+        only yield files with one of these extensions (ignoring case)
+    :param max_depth:
+        0 only lists top itself, 1 also its subdirectories, ... None for unlimited depth
+    :param with_stat:
+        fill size and mtime from the stat result cached by the directory entry
+    :param include_dirs:
+        also yield an entry for every directory
+    :param skip_dirs:
+        names of directories that are neither yielded nor entered
+    :param follow_symlinks:
+        also enter symbolic links to directories (beware of cycles), like os.walk(followlinks=True)
+        symbolic links to files are yielded with the size of their target, special files never
+    :param include_links:
+        False to neither yield nor enter any symbolic link, for example where the target would be counted twice
+    """
+    stack = [(top, 0)]
+    while stack:
+        dirpath, depth = stack.pop()
+        try:
+            with os.scandir(dirpath) as iterator:
+                entries = list(iterator)
+        except OSError as e:
+            print("can not list", dirpath, e)
+            continue
+        subdirs = []
+        for entry in entries:
+            if not include_links and entry.is_symlink():
+                continue
+            is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+            if is_dir:
+                if entry.name in skip_dirs:
+                    continue
+                subdirs.append(entry.path)
+                if not include_dirs:
+                    continue
+            elif not entry.is_file() or extensions is not None and not file_has_ext(entry.name, extensions):
+                continue
+            if with_stat:
+                stats = entry.stat()
+                yield FileEntry(dirpath, entry.name, is_dir, stats.st_size, stats.st_mtime, depth)
+            else:
+                yield FileEntry(dirpath, entry.name, is_dir, 0, 0, depth)
+        if max_depth is None or depth < max_depth:
+            stack.extend((subdir, depth + 1) for subdir in reversed(subdirs))
+
+
 def isfile(*path) -> bool:
     return os.path.isfile(os.path.join(*path))
 
@@ -127,3 +189,31 @@ class Renamer:
 
     def close(self):
         if not self.write: writeToFile(self.inpath + "\\newNames.txt", self.outstring)
+
+
+class WorkerPool:
+    """
+    maps functions over a process or thread pool that is reused for all calls
+    workers=1 runs everything in the calling thread, workers=None uses one worker per cpu
+    """
+    executor: Executor = None
+
+    def __init__(self, workers=1, threads=False):
+        self.workers = workers if workers else os.cpu_count()
+        if self.workers > 1:
+            self.executor = ThreadPoolExecutor(self.workers) if threads else ProcessPoolExecutor(self.workers)
+
+    def map(self, func: Callable, items: Iterable, chunksize=1) -> list:
+        if not self.executor:
+            return [func(item) for item in items]
+        return list(self.executor.map(func, items, chunksize=chunksize))
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
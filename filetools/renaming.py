@@ -11,6 +11,7 @@ __email__ = "marco.volkert24@gmx.de"
 __status__ = "Development"
 
 import datetime as dt
+from itertools import groupby
 
 from .helpers import *
 
@@ -270,11 +271,11 @@ def fixInitialNotNaturalSorting(write=False, year=2017, month=12, day=20, subpat
     matchreg = r"([-\w +]+)_([0-9]+)."
     matchdate = dt.datetime(year, month, day)
     temp = ""
-    for (dirpath, dirnames, filenames) in os.walk(inpath):
+    for dirpath, entries in groupby(walk_entries(inpath), key=lambda entry: entry.dirpath):
         series = []
-        for filename in filenames:
-            fullname = dirpath + "\\" + filename
-            modified = dt.datetime.fromtimestamp(os.path.getmtime(fullname))
+        for entry in entries:
+            filename = entry.name
+            modified = dt.datetime.fromtimestamp(entry.mtime)
             if modified < matchdate: continue
             match = re.search(matchreg, filename)
             if not match: continue
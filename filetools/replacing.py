@@ -1,41 +1,132 @@
 import csv
+import hashlib
+import heapq
+import json
 import os
+import re
+import sqlite3
 import sys
-from shutil import copyfile
-from typing import Dict, List, OrderedDict, Union
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from shutil import copyfile, copymode
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, OrderedDict, Pattern, Tuple, Union
+from xml.sax.saxutils import escape, quoteattr
 
 import ffmpeg
 
 __all__ = ["replace", "replace_playlists", "folders_to_playlist"]
 
-from filetools.helpers import file_has_ext
+from filetools.helpers import WorkerPool, file_has_ext, walk_entries
 
 
-def replace(reverse=False):
+def replace(reverse=False, dry_run=False, workers=1):
+    """
+    replaces the contents of all files below the current directory according to mapping.csv
+    (first column old, second column new) in a single pass per file, lines starting with # are kept
+    all mappings are applied at once, so a replacement is not replaced again by a later mapping row
+    the number of replacements per file and mapping is written to replaceReport.csv
+    :param reverse:
+        replace the second column by the first
+    :param dry_run:
+        only count the replacements and write the report, no file is changed
+    :param workers:
+        number of processes, None for one per cpu
+    """
     csv_filename = "mapping.csv"
+    report_filename = "replaceReport.csv"
+    mapping = _read_replacements(csv_filename, reverse)
+    if not mapping:
+        return
+    pattern = _compile_replacements(mapping)
+    filepaths = [entry.path for entry in walk_entries(os.getcwd(), with_stat=False)
+                 if entry.name not in (csv_filename, report_filename)]
+    with WorkerPool(workers) as pool:
+        hits = pool.map(partial(_replace_in_file, pattern=pattern, mapping=mapping, dry_run=dry_run), filepaths,
+                        chunksize=16)
+
+    totals = Counter()
+    with open(report_filename, "w", encoding="utf-8") as report_file:
+        writer = csv.writer(report_file, delimiter=';', lineterminator='\n')
+        writer.writerow(["path", "old", "new", "hits"])
+        for filepath, file_hits in zip(filepaths, hits):
+            for old, count in file_hits.items():
+                writer.writerow([filepath, old, mapping[old], count])
+            totals.update(file_hits)
+    print("files", "to change:" if dry_run else "changed:", sum(1 for file_hits in hits if file_hits))
+    for old in mapping:
+        print(totals[old], "x", old, "->", mapping[old])
+
+
+def _read_replacements(csv_filename: str, reverse=False) -> Dict[str, str]:
     csv.register_dialect('semicolon', delimiter=';', lineterminator='\r\n')
+    mapping = {}
     with open(csv_filename, "r", encoding="utf-8") as csv_file:
-        reader = csv.reader(csv_file, dialect='semicolon')
-        for row in reader:
+        for row in csv.reader(csv_file, dialect='semicolon'):
+            if len(row) < 2:
+                continue
             old, new = row[:2]
             if reverse:
                 new, old = old, new
-            for (dirpath, dirnames, filenames) in os.walk(os.getcwd()):
-                for filename in filenames:
-                    if filename == csv_filename:
-                        continue
-                    outlines = []
-                    with open(filename, "r", encoding="utf-8") as file:
-                        for line in file:
-                            if not line.startswith('#'):
-                                line = line.replace(old, new)
-                            outlines.append(line)
-                    with open(filename, "w", encoding="utf-8") as file:
-                        file.writelines(outlines)
+            if old:
+                mapping.setdefault(old, new)
+    return mapping
+
+
+def _compile_replacements(mapping: Dict[str, str]) -> Pattern:
+    # longer keys first, so a key that contains another one wins
+    return re.compile("|".join(re.escape(old) for old in sorted(mapping, key=len, reverse=True)))
+
+
+def _replace_in_file(filepath: str, pattern: Pattern, mapping: Dict[str, str], dry_run=False) -> Counter:
+    hits = Counter()
+
+    def replacement(match) -> str:
+        hits[match.group(0)] += 1
+        return mapping[match.group(0)]
+
+    if _is_binary(filepath):
+        return hits
+    outlines = []
+    try:
+        with open(filepath, "r", encoding="utf-8", newline="") as file:
+            for line in file:
+                if not line.startswith('#'):
+                    line = pattern.sub(replacement, line)
+                outlines.append(line)
+    except (UnicodeDecodeError, OSError) as e:
+        print("skipped:", filepath, e)
+        return Counter()
+    if hits and not dry_run:
+        _write_atomic(filepath, outlines)
+    return hits
+
+
+def _is_binary(filepath: str, sniff_size=8192) -> bool:
+    try:
+        with open(filepath, "rb") as file:
+            return b"\0" in file.read(sniff_size)
+    except OSError:
+        return True
+
+
+def _write_atomic(filepath: str, outlines: List[str]):
+    # write to a temporary file next to the target and swap it in, so the file is never half written
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as file:
+            file.writelines(outlines)
+        copymode(filepath, temp_path)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        os.remove(temp_path)
+        raise
 
 
 def replace_playlists(output: str, include_only="", convert=True, copy=False, source_key="PC",
-                      convertible_ext=(".m4a", ".flac", ".wav")):
+                      convertible_ext=(".m4a", ".flac", ".wav"), workers=None):
     """
     prepare playlist for different destination
     :param output:
@@ -53,15 +144,22 @@ def replace_playlists(output: str, include_only="", convert=True, copy=False, so
         valid path on PC where this is executed
     :param convertible_ext:
         extension that should be converted to mp3
+    :param workers:
+        number of conversions and copies running at the same time, None for one per cpu
     :return:
     """
     print(sys.getfilesystemencoding())
     cwd = os.getcwd()
     out_dir = os.path.join(cwd, output)
     os.makedirs(out_dir, exist_ok=True)
-    all_lines = []
     csv_filename = "mapping.csv"
-    mapping_rows = _read_mapping(csv_filename)
+    mapping_index = _MappingIndex(_read_mapping(csv_filename), source_key)
+    manifest = TranscodeManifest(out_dir)
+    jobs = _JobPool(workers, manifest)
+    mp3_parameters = "format=mp3 audio_bitrate=320k map_metadata=0"
+    combined = _PlaylistWriter(os.path.join(out_dir, "combined.m3u8"))
+    combined_lines = set()
+    unresolved = 0
     for (dirpath, dirnames, filenames) in os.walk(cwd):
         if not dirpath == cwd:
             break
@@ -70,18 +168,19 @@ def replace_playlists(output: str, include_only="", convert=True, copy=False, so
                 continue
             if include_only and include_only not in filename:
                 continue
-            outlines = []
-            with open(filename, "r", encoding="utf-8") as file:
+            outlines = set()
+            playlist = _PlaylistWriter(os.path.join(out_dir, filename))
+            with open(filename, "r", encoding="utf-8") as file, playlist:
                 for line in file:
                     if not line.startswith('#'):
                         name_org = line.strip()
+                        manifest.keep_source(name_org)
                         if os.path.isfile(name_org):
-                            entries_for_replace = [
-                                row for row in mapping_rows if row[source_key] in line]
-                            if len(entries_for_replace) != 0:
-                                row = entries_for_replace[0]
+                            row = mapping_index.find(name_org)
+                            if row:
                                 if not row[output]:
                                     row[output] = row[source_key]
+                                conversion_output = False
                                 if output == "IPod":
                                     fileext = name_org[name_org.rfind("."):]
                                     if fileext in convertible_ext:
@@ -89,45 +188,234 @@ def replace_playlists(output: str, include_only="", convert=True, copy=False, so
                                             line[line.rfind(os.path.sep) + 1:]
                                         line = line.replace(fileext, ".mp3")
                                         name_dest = line.strip()
-                                        if convert and not os.path.isfile(name_dest):
-                                            print("convert to mp3: ", name_dest)
-                                            os.makedirs(os.path.dirname(
-                                                name_dest), exist_ok=True)
-                                            try:
-                                                # convert and copy metadata
-                                                inp = ffmpeg.input(name_org)
-                                                out = ffmpeg.output(
-                                                    inp, name_dest, format='mp3', audio_bitrate='320k', map_metadata=0)
-                                                ffmpeg.run(
-                                                    out, overwrite_output=True)
-                                            except ffmpeg.Error as e:
-                                                print(
-                                                    "ffmpeg conversion failed:", e)
+                                        conversion_output = True
+                                        if convert and not manifest.is_current(name_org, name_dest, mp3_parameters,
+                                                                               adopt=True):
+                                            jobs.submit(name_dest, _convert_to_mp3, name_org, name_dest,
+                                                        source=name_org, parameters=mp3_parameters)
                                 else:
                                     line = row[output] + \
                                         line[line.rfind(os.path.sep) + 1:]
-                                if copy:
+                                # every output a playlist still refers to is kept, copied this run or not
+                                manifest.keep(line.strip())
+                                # an mp3 destination is written by the conversion only, never by a copy of the source
+                                if copy and not conversion_output:
                                     name_dest = line.strip()
-                                    if not row[output] == row[source_key] and not os.path.isfile(name_dest):
-                                        os.makedirs(os.path.dirname(
-                                            name_dest), exist_ok=True)
-                                        print('copy: ', name_org, name_dest)
-                                        copyfile(name_org, name_dest)
+                                    if not row[output] == row[source_key]:
+                                        if not manifest.is_current(name_org, name_dest, "copy", adopt=True):
+                                            jobs.submit(name_dest, _copy_file, name_org, name_dest,
+                                                        source=name_org, parameters="copy")
                             else:
+                                unresolved += 1
                                 print(
                                     'warning - destination not configured: ', line)
                         else:
+                            unresolved += 1
                             print('warning - does not exist: ',
                                   filename, name_org)
                     if line not in outlines:
-                        outlines.append(line)
-                    if line not in all_lines:
-                        all_lines.append(line)
-            _create_file(out_dir, filename, outlines)
-            _create_wpl_file(os.path.join(out_dir, filename), outlines)
+                        outlines.add(line)
+                        playlist.write(line)
+                    if line not in combined_lines:
+                        combined_lines.add(line)
+                        combined.write(line)
+
+    combined.close()
+    failures = jobs.wait()
+    # only a complete run over all playlists with every source reachable knows which outputs are not needed anymore,
+    # a missing source may just be an unmounted drive
+    if (copy or convert and output == "IPod") and not include_only and not failures and not unresolved:
+        manifest.remove_orphans()
+    elif unresolved:
+        print("%d sources not resolved - keeping outputs that are not referenced anymore" % unresolved)
+    manifest.close()
+
+
+def _convert_to_mp3(name_org: str, name_dest: str):
+    print("convert to mp3: ", name_dest)
+    os.makedirs(os.path.dirname(name_dest), exist_ok=True)
+    # convert and copy metadata, into a temporary file so an interrupted conversion is not taken as done
+    inp = ffmpeg.input(name_org)
+    out = ffmpeg.output(inp, name_dest + ".part", format='mp3', audio_bitrate='320k', map_metadata=0)
+    ffmpeg.run(out, overwrite_output=True, quiet=True)
+    os.replace(name_dest + ".part", name_dest)
+
+
+def _copy_file(name_org: str, name_dest: str):
+    os.makedirs(os.path.dirname(name_dest), exist_ok=True)
+    print('copy: ', name_org, name_dest)
+    copyfile(name_org, name_dest + ".part")
+    os.replace(name_dest + ".part", name_dest)
+
+
+class _JobPool:
+    """
+    runs conversions and copies in the background while the playlists are written
+    jobs are identified by their destination, so every destination is only processed once
+    threads are sufficient, the actual work is done by ffmpeg processes and file io
+    """
+
+    def __init__(self, workers: int = None, manifest: "TranscodeManifest" = None):
+        self.executor = ThreadPoolExecutor(workers if workers else os.cpu_count())
+        self.manifest = manifest
+        self.destinations = set()
+        self.failures: List[Tuple[str, Exception]] = []
+        self.done = 0
+        self._lock = threading.Lock()
+
+    def submit(self, destination: str, func: Callable, *args, source="", parameters=""):
+        """source and parameters are recorded in the manifest after the job succeeded"""
+        if destination in self.destinations:
+            return
+        self.destinations.add(destination)
+        self.executor.submit(self._run, destination, func, args, source, parameters)
+
+    def _run(self, destination: str, func: Callable, args: tuple, source: str, parameters: str):
+        try:
+            func(*args)
+            if self.manifest and source:
+                self.manifest.record(source, destination, parameters)
+        except (ffmpeg.Error, OSError) as e:
+            with self._lock:
+                self.failures.append((destination, e))
+        with self._lock:
+            self.done += 1
+            print("%d/%d done" % (self.done, len(self.destinations)), destination)
+
+    def wait(self) -> List[Tuple[str, Exception]]:
+        self.executor.shutdown(wait=True)
+        for destination, error in self.failures:
+            stderr = getattr(error, "stderr", None)
+            print("failed:", destination, stderr.decode(errors="replace")[-500:] if stderr else error)
+        return self.failures
+
+
+class TranscodeManifest:
+    """
+    remembers for every output file the source (path, size, mtime), the parameters it was produced with
+    and the size and hash of the output, so unchanged sources are not processed again
+    stored as transcodeManifest.sqlite in the output directory
+    """
+    filename = "transcodeManifest.sqlite"
+
+    def __init__(self, out_dir: str):
+        os.makedirs(out_dir, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(out_dir, self.filename), check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS outputs (destination TEXT PRIMARY KEY, source TEXT, "
+                                "size INTEGER, mtime INTEGER, parameters TEXT, output_size INTEGER, output_hash TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS loudness (source TEXT, target TEXT, size INTEGER, "
+                                "mtime INTEGER, measured TEXT, PRIMARY KEY (source, target))")
+        self.kept = set()
+        self.sources = set()
+        self._lock = threading.Lock()
 
-    _create_file(output, "combined.m3u8", all_lines)
-    _create_wpl_file(os.path.join(out_dir, "combined"), all_lines)
+    def keep(self, destination: str):
+        """marks an output as still referenced, so remove_orphans does not remove it"""
+        self.kept.add(os.path.abspath(destination))
+
+    def keep_source(self, source: str):
+        """marks a source as still referenced, so remove_orphans does not remove any output of it"""
+        self.sources.add(os.path.abspath(source))
+
+    def is_current(self, source: str, destination: str, parameters: str, adopt=False) -> bool:
+        """
+        :param adopt:
+            take an existing output without manifest entry as current and record it
+        """
+        destination = os.path.abspath(destination)
+        if not os.path.isfile(destination):
+            return False
+        with self._lock:
+            row = self.connection.execute("SELECT source, size, mtime, parameters, output_size FROM outputs "
+                                          "WHERE destination = ?", (destination,)).fetchone()
+        if not row:
+            if adopt:
+                self.record(source, destination, parameters)
+            return adopt
+        stats = os.stat(source)
+        output_size = os.path.getsize(destination)
+        return (row[0] == os.path.abspath(source) and row[1] == stats.st_size and row[2] == stats.st_mtime_ns
+                and row[3] == parameters and row[4] == output_size)
+
+    def record(self, source: str, destination: str, parameters: str):
+        stats = os.stat(source)
+        output_hash = _file_hash(destination)
+        with self._lock:
+            self.connection.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (os.path.abspath(destination), os.path.abspath(source), stats.st_size,
+                                     stats.st_mtime_ns, parameters, os.path.getsize(destination), output_hash))
+            self.connection.commit()
+
+    def loudness(self, source: str, target: tuple) -> Optional[Dict[str, str]]:
+        """loudnorm measurement of an unchanged source, None if it has to be measured"""
+        stats = os.stat(source)
+        with self._lock:
+            row = self.connection.execute("SELECT size, mtime, measured FROM loudness WHERE source = ? AND target = ?",
+                                          (os.path.abspath(source), repr(target))).fetchone()
+        if not row or row[0] != stats.st_size or row[1] != stats.st_mtime_ns:
+            return None
+        return json.loads(row[2])
+
+    def record_loudness(self, source: str, target: tuple, measured: Dict[str, str]):
+        stats = os.stat(source)
+        with self._lock:
+            self.connection.execute("INSERT OR REPLACE INTO loudness VALUES (?, ?, ?, ?, ?)",
+                                    (os.path.abspath(source), repr(target), stats.st_size, stats.st_mtime_ns,
+                                     json.dumps(measured)))
+            self.connection.commit()
+
+    def remove_orphans(self):
+        """removes the outputs whose source is not referenced anymore, neither output nor source were kept"""
+        with self._lock:
+            rows = self.connection.execute("SELECT destination, source FROM outputs").fetchall()
+        for destination, source in rows:
+            if destination in self.kept or source in self.sources:
+                continue
+            print("remove orphaned output:", destination)
+            if os.path.isfile(destination):
+                os.remove(destination)
+            with self._lock:
+                self.connection.execute("DELETE FROM outputs WHERE destination = ?", (destination,))
+        with self._lock:
+            self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def _file_hash(filepath: str, block_size=1024 * 1024) -> str:
+    digest = hashlib.blake2b()
+    with open(filepath, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _MappingIndex:
+    """
+    finds the mapping row whose source_key column is the longest prefix of a path
+    instead of testing every row against every playlist line
+    """
+
+    def __init__(self, mapping_rows: List[Dict[str, str]], source_key: str):
+        self.mapping_rows = mapping_rows
+        self.source_key = source_key
+        self.rows_by_prefix: Dict[str, Dict[str, str]] = {}
+        for row in mapping_rows:
+            self.rows_by_prefix.setdefault(row[source_key], row)
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.rows_by_prefix}, reverse=True)
+
+    def find(self, path: str) -> Union[Dict[str, str], None]:
+        for length in self.prefix_lengths:
+            row = self.rows_by_prefix.get(path[:length])
+            if row is not None:
+                return row
+        # a source path in the middle of the line, as found by the former substring search
+        for row in self.mapping_rows:
+            if row[self.source_key] in path:
+                return row
+        return None
 
 
 def _read_mapping(csv_filename: str) -> List[Union[Dict[str, str], OrderedDict[str, str]]]:
@@ -137,42 +425,96 @@ def _read_mapping(csv_filename: str) -> List[Union[Dict[str, str], OrderedDict[s
         return [row for row in reader]
 
 
-def _create_file(out_dir, filename, outlines):
-    with open(os.path.join(out_dir, filename), "w", encoding="utf-8") as file:
-        file.writelines(outlines)
+class _PlaylistWriter:
+    """writes a playlist as m3u and .wpl at the same time, line by line"""
+
+    def __init__(self, out_filename: str):
+        """
+        :param out_filename:
+            path of the m3u playlist, the wpl playlist gets the same name with extension .wpl
+        """
+        base_filename = os.path.splitext(out_filename)[0]
+        title = os.path.basename(base_filename)
+        self.m3u = open(out_filename, "w", encoding="utf-8")
+        self.wpl = open(base_filename + ".wpl", "w", encoding="utf-8")
+        self.wpl.write('<?wpl version="1.0"?>\n')
+        self.wpl.write('<smil><head><author/>\n')
+        self.wpl.write('<title>' + escape(title) + '</title>\n')
+        self.wpl.write('</head><body><seq>\n')
+
+    def write(self, line: str):
+        line = line.rstrip("\n")
+        self.m3u.write(line + "\n")
+        if not line.startswith('#'):
+            self.wpl.write('<media src=' + quoteattr(line.strip()) + '/>\n')
 
+    def close(self):
+        self.wpl.write('</seq></body></smil>\n')
+        self.m3u.close()
+        self.wpl.close()
 
-def _create_wpl_file(out_filename: str, outlines: List[str]):
-    out_filename = out_filename[:out_filename.rfind('.')]
-    title = out_filename[out_filename.rfind(os.path.sep) + 1:]
-    with open(out_filename + ".wpl", "w", encoding="utf-8") as file:
-        file.write('<?wpl version="1.0"?>\n')
-        file.write('<smil><head><author/>\n')
-        file.write('<title>' + title + '</title>\n')
-        file.write('</head><body><seq>\n')
-        for line in outlines:
-            if not line.startswith('#'):
-                file.write('<media src="' + line.strip() + '"/>\n')
-        file.write('</seq></body></smil>\n')
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _sorted_lines(lines: Iterable[str], chunk_size=100000) -> Iterator[str]:
+    """
+    sorts lines with bounded memory: sorted runs of chunk_size lines are spilled to temporary files
+    and merged at the end
+    """
+    runs = []
+    chunk = []
+    try:
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                runs.append(_spill(sorted(chunk)))
+                chunk = []
+        chunk.sort()
+        files = [open(run, "r", encoding="utf-8") for run in runs]
+        try:
+            yield from heapq.merge(chunk, *files)
+        finally:
+            for file in files:
+                file.close()
+    finally:
+        for run in runs:
+            os.remove(run)
+
+
+def _spill(lines: List[str]) -> str:
+    fd, run = tempfile.mkstemp(prefix="playlist", suffix=".run")
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        file.writelines(lines)
+    return run
 
 
 def folders_to_playlist():
     cwd = os.getcwd()
     out_dir = os.path.join(cwd, "playlists")
     os.makedirs(out_dir, exist_ok=True)
-    all_lines = []
-    for (dirpath, dirnames, filenames) in os.walk(cwd):
-        basename = os.path.basename(dirpath)
-        outlines = [os.path.join(dirpath, filename + "\n") for filename in filenames if
-                    file_has_ext(filename, ['.mp3', '.m4a', '.mp4', '.flv'])]
-        if not outlines:
-            continue
-        playlist_name = os.path.join(out_dir, basename + ".m3u8")
-        _create_file(out_dir, basename + ".m3u8", outlines)
-        _create_wpl_file(playlist_name, outlines)
-        all_lines += outlines
-    all_lines.sort()
-    _create_file(out_dir, "combined.m3u8", all_lines)
+
+    def all_lines():
+        for (dirpath, dirnames, filenames) in os.walk(cwd):
+            basename = os.path.basename(dirpath)
+            playlist = None
+            for filename in filenames:
+                if not file_has_ext(filename, ['.mp3', '.m4a', '.mp4', '.flv']):
+                    continue
+                if not playlist:
+                    playlist = _PlaylistWriter(os.path.join(out_dir, basename + ".m3u8"))
+                line = os.path.join(dirpath, filename + "\n")
+                playlist.write(line)
+                yield line
+            if playlist:
+                playlist.close()
+
+    with _PlaylistWriter(os.path.join(out_dir, "combined.m3u8")) as combined:
+        for line in _sorted_lines(all_lines()):
+            combined.write(line)
 
 
 def _ext_to_format(ext: str):
@@ -181,24 +523,97 @@ def _ext_to_format(ext: str):
     return ext
 
 
-def normalize():
+def normalize(output="output", workers: int = None, target=(-16, -1.5, 11)):
+    """
+    writes loudness normalized copies of all audio and video files below the current directory to output
+    uses two-pass loudnorm: the loudness of every file is measured first and then applied in linear mode
+    the measurements are cached in the manifest, files whose source and parameters did not change
+    since the last run are skipped, outputs whose source is gone are removed
+    :param workers:
+        number of ffmpeg processes running at the same time, one per cpu if None
+    :param target:
+        integrated loudness, true peak and loudness range to normalize to
+    """
     cwd = os.getcwd()
+    parameters = "loudnorm I=%s TP=%s LRA=%s linear audio_bitrate=260k map_metadata=0" % target
+    manifest = TranscodeManifest(output)
+    jobs = []
     for (dirpath, dirnames, filenames) in os.walk(cwd):
-        basename = os.path.basename(dirpath)
-        out_dir = os.path.join("output", os.path.relpath(dirpath, cwd))
+        if dirpath == cwd:
+            dirnames[:] = [dirname for dirname in dirnames if not dirname == output]
+        out_dir = os.path.join(output, os.path.relpath(dirpath, cwd))
         os.makedirs(out_dir, exist_ok=True)
         for filename in filenames:
             if not file_has_ext(filename, ['.mp3', '.m4a', '.mp4', '.flv']):
                 continue
-            ext = filename[filename.rfind(".") + 1:]
             inp = os.path.join(dirpath, filename)
             outp = os.path.join(out_dir, filename)
-            try:
-                stream = ffmpeg.input(inp)
-                # loudnorm filter normalizes audio levels; adjust params if needed
-                stream = stream.filter('loudnorm')
-                out = ffmpeg.output(stream, outp, format=_ext_to_format(
-                    ext), audio_bitrate='260k', map_metadata=0)
-                ffmpeg.run(out, overwrite_output=True)
-            except ffmpeg.Error as e:
-                print('ffmpeg normalization failed for', inp, e)
+            manifest.keep(outp)
+            manifest.keep_source(inp)
+            if not manifest.is_current(inp, outp, parameters):
+                jobs.append((inp, outp))
+
+    # ffmpeg runs in its own process, so threads are enough to keep all cores busy
+    with WorkerPool(workers, threads=True) as pool:
+        measure = [inp for inp, outp in jobs if manifest.loudness(inp, target) is None]
+        print("analyze loudness of %d files" % len(measure))
+        for inp, measured in zip(measure, pool.map(partial(_measure_loudness, target=target), measure)):
+            if measured:
+                manifest.record_loudness(inp, target, measured)
+        jobs = [(inp, outp, manifest.loudness(inp, target)) for inp, outp in jobs]
+        failures = sum(1 for job in jobs if not job[2])
+        jobs = [job for job in jobs if job[2]]
+        print("normalize %d files" % len(jobs))
+        for (inp, outp, measured), done in zip(jobs, pool.map(partial(_apply_loudness, target=target), jobs)):
+            if done:
+                manifest.record(inp, outp, parameters)
+            else:
+                failures += 1
+    # nothing found usually means the sources are not reachable, not that they were all deleted
+    if manifest.sources and not failures:
+        manifest.remove_orphans()
+    manifest.close()
+
+
+def _measure_loudness(inp: str, target: tuple) -> Optional[Dict[str, str]]:
+    # first pass: loudnorm prints the measured values as json at the end of stderr
+    integrated, true_peak, loudness_range = target
+    try:
+        stream = ffmpeg.input(inp).filter('loudnorm', I=integrated, TP=true_peak, LRA=loudness_range,
+                                          print_format='json')
+        _, err = ffmpeg.output(stream, '-', format='null').run(capture_stdout=True, capture_stderr=True)
+    except ffmpeg.Error as e:
+        print('ffmpeg loudness analysis failed for', inp, e)
+        return None
+    match = re.search(r"\{[^{}]*\}\s*$", err.decode("utf-8", errors="replace"))
+    if not match:
+        print('no loudness measured for', inp)
+        return None
+    return json.loads(match.group(0))
+
+
+def _apply_loudness(job: Tuple[str, str, Dict[str, str]], target: tuple) -> bool:
+    # second pass: apply the measured values in linear mode, written to a part file first
+    inp, outp, measured = job
+    integrated, true_peak, loudness_range = target
+    ext = inp[inp.rfind(".") + 1:]
+    part = outp + ".part"
+    try:
+        stream = ffmpeg.input(inp).filter('loudnorm', I=integrated, TP=true_peak, LRA=loudness_range,
+                                          measured_I=measured["input_i"], measured_TP=measured["input_tp"],
+                                          measured_LRA=measured["input_lra"],
+                                          measured_thresh=measured["input_thresh"],
+                                          offset=measured["target_offset"], linear='true')
+        out = ffmpeg.output(stream, part, format=_ext_to_format(ext), audio_bitrate='260k', map_metadata=0)
+        ffmpeg.run(out, overwrite_output=True, quiet=True)
+        os.replace(part, outp)
+        print("normalized:", outp)
+        return True
+    except ffmpeg.Error as e:
+        print('ffmpeg normalization failed for', inp, e.stderr.decode("utf-8", errors="replace")[-500:]
+              if e.stderr else e)
+    except (OSError, KeyError) as e:
+        print('normalization failed for', inp, e)
+    if os.path.isfile(part):
+        os.remove(part)
+    return False
@@ -9,49 +9,189 @@ __copyright__ = "Copyright 2017, Marco Volkert"
 __email__ = "marco.volkert24@gmx.de"
 __status__ = "Development"
 
+import csv
+import hashlib
 import shutil
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from functools import partial
+from typing import Tuple
 
-from .compare import are_similar
+import numpy as np
+from natsort import natsorted
+
+from .compare import blur_score, has_skimage, hamming_distances, structural_similarities, structural_similarity_pairs
+from .featurecache import FeatureCache
 from .helpers import *
 
 __all__ = ["detectSimilar", "detectSimilar2", "detectSimilarSeries", "detectSimilar2SelfMultiple",
-           "detectSimilarSelfMultiple", "detectSimilarSeriesPerFolder", "deleteNewNamesTxt", "findSameNames",
-           "findSimilarNames"]
+           "detectSimilarSelfMultiple", "detectSimilarSeriesPerFolder", "detectBlurry", "deleteNewNamesTxt",
+           "findSameNames", "findSimilarNames", "findDuplicateFiles"]
 
 
-def detectSimilar(pathA: str, pathB=""):
+def detectSimilar(pathA: str, pathB="", use_hash=False, max_distance=10, use_cache=False, workers=1):
+    """
+    moves pictures of pathB that are similar to a picture of pathA to pathB/multiple
+    :param use_hash:
+        only compare pairs whose difference hashes differ in at most max_distance bits
+        instead of running the full comparison on every pair
+    :param max_distance:
+        number of differing hash bits (of 64) that still counts as candidate
+    :param use_cache:
+        keep thumbnails in a featureCache.sqlite per directory, so later runs only decode new or changed files
+    :param workers:
+        number of processes for decoding and comparing, None for one per cpu
+    """
     if not pathB: pathB = pathA
     filenamesA = getFileNamesOfMainDir(pathA)
     filenamesB = getFileNamesOfMainDir(pathB)
+    candidates = _similar_candidates(filenamesA, filenamesB)
+    _detectSimilarPairs(pathA, pathB, filenamesA, filenamesB, candidates, use_cache, workers,
+                        max_distance if use_hash else None)
 
-    filenamesB = filenamesB[::-1]
-    for filenameA in filenamesA:
-        print(filenameA)
-        for filenameB in filenamesB:
-            if filenameA == filenameB: break
-            if not isfile(pathA, filenameA) or not isfile(pathB, filenameB): continue
-            if not are_similar((pathA, filenameA), (pathB, filenameB), 0.95): continue
-            moveToSubpath(filenameB, pathB, "multiple")
 
-
-def detectSimilar2(pathA: str, pathB="", startwith=""):
+def detectSimilar2(pathA: str, pathB="", startwith="", use_cache=False, workers=1, window=40):
+    """
+    moves pictures of pathB that are similar to one of the window - 1 preceding pictures of pathA to pathB/multiple
+    the natsorted pictures are streamed: each one is decoded once and only the thumbnails of the window are kept
+    :param startwith:
+        filename of pathA to resume with
+    """
     if not pathB: pathB = pathA
-    filenamesA = getFileNamesOfMainDir(pathA)
-    filenamesB = getFileNamesOfMainDir(pathB)
-
-    found = False
+    if not has_skimage:
+        print("no skimage installed")
+        return
+    filenamesA = natsorted(getFileNamesOfMainDir(pathA))
+    filenamesB = natsorted(getFileNamesOfMainDir(pathB))
+    if startwith and startwith not in filenamesA: return
+    start = filenamesA.index(startwith) if startwith else 0
+    same = pathA == pathB
+    cache = FeatureCache(persistent=use_cache, keep_in_memory=False)
+    pool = WorkerPool(workers)
+    streamA = enumerate(_iter_thumbnails(cache, pool, pathA, filenamesA[start:]), start)
+    streamB = streamA if same else enumerate(_iter_thumbnails(cache, pool, pathB, filenamesB[start + 1:]), start + 1)
+    # (index, filename, thumbnail) of the pictures of pathA the current picture is compared with
+    window_buffer = deque()
+    for j, (filenameB, pictureB) in streamB:
+        if not same:
+            entryA = next(streamA, None)
+            if entryA and entryA[1][1] is not None:
+                window_buffer.append((entryA[0], *entryA[1]))
+        while window_buffer and window_buffer[0][0] < j - (window - 1):
+            window_buffer.popleft()
+        if not same and not window_buffer and j > len(filenamesA): break
+        if pictureB is None: continue
+        print(filenameB)
+        similar = ""
+        if window_buffer:
+            stack = np.stack([pictureB] + [pictureA for i, filenameA, pictureA in window_buffer])
+            scores = structural_similarity_pairs(stack, [(0, k) for k in range(1, len(stack))])
+            for (i, filenameA, pictureA), score in zip(window_buffer, scores):
+                if 0.95 < score:
+                    similar = filenameA
+                    break
+        if similar:
+            print(similar, filenameB)
+            _moveToSubpath(cache, filenameB, pathB, "multiple")
+        elif same:
+            window_buffer.append((j, filenameB, pictureB))
+    pool.close()
+    cache.close()
+
+
+def _iter_thumbnails(cache: FeatureCache, pool: WorkerPool, dirpath: str, filenames: List[str], block_size=256):
+    # decodes block wise on the pool, so at most block_size thumbnails are held besides the caller's
+    for start in range(0, len(filenames), block_size):
+        paths = [(dirpath, filename) for filename in filenames[start:start + block_size]]
+        cache.prefetch(paths, pool=pool)
+        for path in paths:
+            yield path[1], cache.thumbnail(path)
+
+
+def _detectSimilarPairs(pathA: str, pathB: str, filenamesA: List[str], filenamesB: List[str], candidates: Iterable,
+                        use_cache: bool, workers: int, max_distance: int = None, similarity=0.95, block_size=4096):
+    """
+    compares the candidate pairs block wise on the pool, the moves are applied afterwards
+    in the same order as a sequential comparison would do them
+    """
+    if not has_skimage:
+        print("no skimage installed")
+        return
+    cache = FeatureCache(persistent=use_cache)
+    pool = WorkerPool(workers)
+    pathsA = [(pathA, filename) for filename in filenamesA]
+    pathsB = [(pathB, filename) for filename in filenamesB]
+    cache.prefetch(pathsA + pathsB, pool=pool)
+    if max_distance is not None:
+        hashesA = _stack_hashes([cache.hash(path) for path in pathsA])
+        hashesB = _stack_hashes([cache.hash(path) for path in pathsB])
+    moved = set()
+
+    def commit(pairs: List[Tuple[int, int]]):
+        scores = _score_pairs(pool, cache, [(pathsA[i], pathsB[j]) for i, j in pairs])
+        for (i, j), score in zip(pairs, scores):
+            if pathA == pathB and filenamesA[i] in moved or filenamesB[j] in moved: continue
+            if not similarity < score: continue
+            print(filenamesA[i], filenamesB[j], score)
+            _moveToSubpath(cache, filenamesB[j], pathB, "multiple")
+            moved.add(filenamesB[j])
+
+    block = []
+    for i, candidatesB in candidates:
+        if pathA == pathB and filenamesA[i] in moved or cache.thumbnail(pathsA[i]) is None: continue
+        print(filenamesA[i])
+        candidatesB = np.asarray(candidatesB, dtype=int)
+        if max_distance is not None:
+            candidatesB = candidatesB[hamming_distances(hashesB[candidatesB], hashesA[i]) <= max_distance]
+        block.extend((i, j) for j in candidatesB if filenamesB[j] not in moved)
+        if len(block) >= block_size:
+            commit(block)
+            block = []
+    commit(block)
+    pool.close()
+    cache.close()
+
+
+def _similar_candidates(filenamesA: List[str], filenamesB: List[str]):
+    # same visiting order as detectSimilar: filenamesB backwards until filenameA itself is reached
+    indexB = {filename: j for j, filename in enumerate(filenamesB)}
     for i, filenameA in enumerate(filenamesA):
-        if startwith == filenameA: found = True
-        if startwith and not found: continue
-        print(filenameA)
-        for j, filenameB in enumerate(filenamesB[i + 1:i + 40]):
-            if not isfile(pathA, filenameA) or not isfile(pathB, filenameB): continue
-            if not are_similar((pathA, filenameA), (pathB, filenameB), 0.95): continue
-            moveToSubpath(filenameB, pathB, "multiple")
-
-
-def detectSimilarSeries(similarity=0.95, checkSameName=True, useSubPath=True, subPath=""):
+        yield i, range(len(filenamesB) - 1, indexB.get(filenameA, -1), -1)
+
+
+def _score_pairs(pool: WorkerPool, cache: FeatureCache, pairs: List[Tuple[tuple, tuple]],
+                 chunk_size=256) -> List[float]:
+    # pairs with a picture that could not be read get a score of -1
+    scores = [-1.0] * len(pairs)
+    valid = []
+    image_pairs = []
+    for k, (pathA, pathB) in enumerate(pairs):
+        imageA = cache.thumbnail(pathA)
+        imageB = cache.thumbnail(pathB)
+        if imageA is None or imageB is None: continue
+        valid.append(k)
+        image_pairs.append((imageA, imageB))
+    chunks = [image_pairs[k:k + chunk_size] for k in range(0, len(image_pairs), chunk_size)]
+    valid_scores = [score for chunk_scores in pool.map(structural_similarities, chunks) for score in chunk_scores]
+    for k, score in zip(valid, valid_scores):
+        scores[k] = score
+    return scores
+
+
+def _stack_hashes(hashes: list) -> np.ndarray:
+    stack = np.zeros((len(hashes), 8), dtype=np.uint8)
+    for i, image_hash in enumerate(hashes):
+        if image_hash is not None:
+            stack[i] = image_hash
+    return stack
+
+
+def _moveToSubpath(cache: FeatureCache, filename: str, dirpath: str, subpath: str):
+    moveToSubpath(filename, dirpath, subpath)
+    cache.evict((dirpath, filename))
+
+
+def detectSimilarSeries(similarity=0.95, checkSameName=True, useSubPath=True, subPath="", use_cache=False,
+                        workers=1):
     def getMainName(nameMid):
         matchreg = r"([-\w +]+)_([0-9]+)"
         match = re.search(matchreg, nameMid)
@@ -66,6 +206,11 @@ def detectSimilarSeries(similarity=0.95, checkSameName=True, useSubPath=True, su
     moveList = []
     dircounter = 1
     outstring = ""
+    cache = FeatureCache(persistent=use_cache)
+    pool = WorkerPool(workers)
+    series_starts = [filename for filename in filenames
+                     if re.search(matchreg, filename[1]) and re.search(matchreg, filename[1]).group(2) == "01"]
+    cache.prefetch(series_starts, pool=pool)
     for i, filenameA in enumerate(filenames):
 
         if not isfile(*filenameA): continue
@@ -77,6 +222,14 @@ def detectSimilarSeries(similarity=0.95, checkSameName=True, useSubPath=True, su
         lastNameMid = matchA.group(1)
         lastNameMain = getMainName(lastNameMid)
         moveList.append(filenameA)
+        # score all series starts that can be reached from filenameA at once
+        candidates = []
+        for filenameB in filenames[i + 1:]:
+            matchB = re.search(matchreg, filenameB[1])
+            if not matchB: continue
+            if checkSameName and not getMainName(matchB.group(1)) == lastNameMain: break
+            if matchB.group(2) == "01" and isfile(*filenameB): candidates.append(filenameB)
+        scores = dict(zip(candidates, _score_pairs(pool, cache, [(filenameA, candidate) for candidate in candidates])))
         for j, filenameB in enumerate(filenames[i + 1:]):
             if not isfile(*filenameA) or not isfile(*filenameB): continue
             matchB = re.search(matchreg, filenameB[1])
@@ -90,7 +243,7 @@ def detectSimilarSeries(similarity=0.95, checkSameName=True, useSubPath=True, su
                 moveList.append(filenameB)
                 continue
             if not namEnd == "01": continue
-            if not are_similar(filenameA, filenameB, similarity): continue
+            if not similarity < scores.get(filenameB, -1): continue
             print("Bsim", filenameB[1])
             outstring += filenameA[0] + os.path.sep + filenameA[1] + " " + filenameB[0] + os.path.sep + filenameB[
                 1] + "\n"
@@ -101,17 +254,19 @@ def detectSimilarSeries(similarity=0.95, checkSameName=True, useSubPath=True, su
             dirname = "%03d" % dircounter
             dircounter += 1
             for filename in moveList:
-                moveToSubpath(filename[1], filename[0], dirname)
+                _moveToSubpath(cache, filename[1], filename[0], dirname)
         moveList = []
+    pool.close()
+    cache.close()
     writeToFile(path + "\\similar.txt", outstring)
 
 
-def detectSimilarSeriesPerFolder(similarity=0.95, checkSameName=False, useSubPath=True):
+def detectSimilarSeriesPerFolder(similarity=0.95, checkSameName=False, useSubPath=True, use_cache=False, workers=1):
     inpath = concatPath("")
     for (dirpath, dirnames, filenames) in os.walk(inpath):
         if not inpath == dirpath: continue
         for dirname in dirnames:
-            detectSimilarSeries(similarity, checkSameName, useSubPath, dirname)
+            detectSimilarSeries(similarity, checkSameName, useSubPath, dirname, use_cache, workers)
 
 
 def concat_files(concat_filename="similar.txt"):
@@ -134,20 +289,64 @@ def concat_files(concat_filename="similar.txt"):
     writeToFile(inpath + os.sep + concat_filename, outstring)
 
 
-def detectSimilarSelfMultiple(subpath=""):
+def detectSimilarSelfMultiple(subpath="", use_hash=False, use_cache=False, workers=1):
     inpath = concatPath(subpath)
     for (dirpath, dirnames, filenames) in os.walk(inpath):
         if os.path.basename(dirpath) == "multiple": continue
         print(dirpath)
-        detectSimilar(dirpath)
+        detectSimilar(dirpath, use_hash=use_hash, use_cache=use_cache, workers=workers)
 
 
-def detectSimilar2SelfMultiple(startwith="", subpath=""):
+def detectSimilar2SelfMultiple(startwith="", subpath="", use_cache=False, workers=1):
     inpath = concatPath(subpath)
     for (dirpath, dirnames, filenames) in os.walk(inpath):
         if os.path.basename(dirpath) == "multiple": continue
         print(dirpath)
-        detectSimilar2(dirpath, startwith=startwith)
+        detectSimilar2(dirpath, startwith=startwith, use_cache=use_cache, workers=workers)
+
+
+def detectBlurry(subpath="", threshold=100, workers=None, reduction=4, rescan=False):
+    """
+    moves pictures whose variance of laplacian is below threshold to a subfolder blurry
+    the scores of all pictures are written to blurry.csv and reused in later runs,
+    so the threshold can be tuned without decoding the pictures again
+    :param workers:
+        number of processes for scoring, None for one per cpu
+    :param reduction:
+        decode pictures at 1/reduction of their size (1, 2, 4 or 8)
+    :param rescan:
+        ignore the scores of an existing blurry.csv
+    """
+    inpath = concatPath(subpath)
+    csv_filename = os.path.join(inpath, "blurry.csv")
+    csv.register_dialect('semicolon', delimiter=';', lineterminator='\n')
+    # a score is only reused for a file of the same size and modification time, like in the FeatureCache
+    known_scores = {}
+    if not rescan and os.path.isfile(csv_filename):
+        with open(csv_filename, "r", encoding="utf-8") as csv_file:
+            for row in csv.DictReader(csv_file, dialect='semicolon'):
+                key = (row["path"], row["name"], row.get("size"), row.get("mtime"))
+                known_scores[key] = float(row["score"]) if row["score"] else None
+
+    entries = natsorted([(entry.dirpath, entry.name, str(entry.size), str(entry.mtime)) for entry in
+                         walk_entries(inpath, [".jpg", ".jpeg"], skip_dirs=["blurry"])])
+    paths = [entry[:2] for entry in entries]
+    missing = [entry for entry in entries if entry not in known_scores]
+    with WorkerPool(workers) as pool:
+        scores = pool.map(partial(blur_score, reduction=reduction), [entry[:2] for entry in missing], chunksize=16)
+    known_scores.update(zip(missing, scores))
+    # rows of pictures that were moved or deleted since the last run are dropped
+    scores = [known_scores[entry] for entry in entries]
+
+    with open(csv_filename, "w", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file, dialect='semicolon')
+        writer.writerow(["path", "name", "size", "mtime", "score"])
+        for entry, score in zip(entries, scores):
+            writer.writerow(list(entry) + ["" if score is None else "%.2f" % score])
+    for path, score in zip(paths, scores):
+        if score is None or not score < threshold: continue
+        print("blurry", path[1], "%.2f" % score)
+        moveToSubpath(path[1], path[0], "blurry")
 
 
 def deleteNewNamesTxt(subpath=""):
@@ -185,19 +384,19 @@ def findSimilarNames(ignore: str = r'^\d+', exclude_dir: str = "html", exclude_f
     inpath = concatPath("")
     fileDict = OrderedDict()
     dirDict = OrderedDict()
-    for (dirpath, dirnames, filenames) in os.walk(inpath):
-        for filename in filenames:
-            if exclude_file_ext and file_has_ext(filename, [exclude_file_ext]):
-                continue
-            filename_striped = filename.replace(ignore, '')
-            fileDict.setdefault(filename_striped, [])
-            fileDict[filename_striped].append(dirpath)
-        for dirname in dirnames:
-            if exclude_dir in dirpath:
+    for entry in walk_entries(inpath, with_stat=False, include_dirs=True):
+        if entry.is_dir:
+            if exclude_dir in entry.dirpath:
                 continue
-            dirname_striped = dirname.replace(ignore, '')
+            dirname_striped = entry.name.replace(ignore, '')
             dirDict.setdefault(dirname_striped, [])
-            dirDict[dirname_striped].append(dirpath)
+            dirDict[dirname_striped].append(entry.dirpath)
+        else:
+            if exclude_file_ext and file_has_ext(entry.name, [exclude_file_ext]):
+                continue
+            filename_striped = entry.name.replace(ignore, '')
+            fileDict.setdefault(filename_striped, [])
+            fileDict[filename_striped].append(entry.dirpath)
 
     outstring_files = _dict_to_string(fileDict)
     outstring_dirs = _dict_to_string(dirDict)
@@ -205,6 +404,77 @@ def findSimilarNames(ignore: str = r'^\d+', exclude_dir: str = "html", exclude_f
     writeToFile(inpath + "\\sameNames_dirs.txt", outstring_dirs)
 
 
+def findDuplicateFiles(subpath="", workers=8, edge_size=64 * 1024):
+    """
+    finds byte identical files of any type and writes them to duplicateFiles.txt
+    files are grouped by size first, only files of equal size get a hash of their first and last edge_size bytes
+    and only files whose partial hashes are still equal are hashed completely
+    :param workers:
+        number of threads reading files
+    """
+    inpath = concatPath(subpath)
+    files_by_size = OrderedDict()
+    # a link to a file is no duplicate of its target
+    for entry in walk_entries(inpath, include_links=False):
+        if not entry.size: continue
+        files_by_size.setdefault(entry.size, []).append(entry.path)
+    candidates = [filepath for filepaths in files_by_size.values() if len(filepaths) > 1 for filepath in filepaths]
+    print("files of equal size:", len(candidates))
+
+    duplicates = OrderedDict()
+    with WorkerPool(workers, threads=True) as pool:
+        partial_groups = _group_by(pool, partial(_partial_hash, edge_size=edge_size), candidates)
+        full_candidates = []
+        for key, filepaths in partial_groups.items():
+            if len(filepaths) < 2: continue
+            if os.path.getsize(filepaths[0]) <= 2 * edge_size:
+                # the partial hash already covered the whole file
+                duplicates[key] = filepaths
+            else:
+                full_candidates.extend(filepaths)
+        print("files of equal partial hash:", len(full_candidates))
+        for key, filepaths in _group_by(pool, _full_hash, full_candidates).items():
+            if len(filepaths) > 1:
+                duplicates[key] = filepaths
+
+    writeToFile(os.path.join(inpath, "duplicateFiles.txt"), _dict_to_string(duplicates))
+
+
+def _group_by(pool: WorkerPool, key_func, filepaths: List[str]) -> OrderedDict:
+    groups = OrderedDict()
+    for filepath, key in zip(filepaths, pool.map(key_func, filepaths)):
+        if key:
+            groups.setdefault(key, []).append(filepath)
+    return groups
+
+
+def _partial_hash(filepath: str, edge_size: int) -> str:
+    try:
+        size = os.path.getsize(filepath)
+        digest = hashlib.blake2b(str(size).encode())
+        with open(filepath, "rb") as file:
+            digest.update(file.read(edge_size))
+            if size > edge_size:
+                file.seek(max(edge_size, size - edge_size))
+                digest.update(file.read(edge_size))
+    except OSError as e:
+        print("can not read", filepath, e)
+        return ""
+    return digest.hexdigest()
+
+
+def _full_hash(filepath: str, block_size=1024 * 1024) -> str:
+    digest = hashlib.blake2b()
+    try:
+        with open(filepath, "rb") as file:
+            for block in iter(lambda: file.read(block_size), b""):
+                digest.update(block)
+    except OSError as e:
+        print("can not read", filepath, e)
+        return ""
+    return digest.hexdigest()
+
+
 def _dict_to_string(file_dict: OrderedDict):
     outstring = ""
     for filename in file_dict:
@@ -1,39 +1,298 @@
 import csv
+import heapq
 import os
-from collections import OrderedDict
-from typing import List
-
-
-def writeDirsAndFiles():
-    inpath = os.getcwd()
-    dicts: List[OrderedDict] = []
-    for (dirpath, dirnames, filenames) in os.walk(inpath):
-        for filename in filenames:
-            stats = os.stat(dirpath + os.sep + filename)
-            file_data = OrderedDict()
-            file_data["path"] = dirpath
-            file_data["name"] = filename
-            file_data["isDir"] = False
-            file_data["size"] = stats.st_size
-            file_data["depth"] = len(dirpath.split(os.sep)) + 1
-            dicts.append(file_data)
-        for dirname in dirnames:
-            stats = os.stat(dirpath + os.sep + dirname)
-            file_data = OrderedDict()
-            file_data["path"] = dirpath
-            file_data["name"] = dirname
-            file_data["isDir"] = True
-            file_data["size"] = stats.st_size
-            file_data["depth"] = len(dirpath.split(os.sep))
-            dicts.append(file_data)
-
-    writeCsvFile(dicts)
-
-
-def writeCsvFile(dicts: List[OrderedDict]):
-    csv_filename = "treeSize.csv"
+import queue
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from filetools.helpers import walk_entries
+
+csv_filename = "treeSize.csv"
+snapshot_filename = "treeSize.sqlite"
+
+
+def writeDirsAndFiles(roots: List[str] = None, incremental=False, workers=16, report_changes=10, report_largest=10):
+    """
+    writes all files and directories below the roots to treeSize.csv in the current directory,
+    the size of a directory is the total size of everything below it
+    the directory sizes and modification times are stored in treeSize.sqlite
+    :param roots:
+        directories to scan, the current directory if empty
+    :param incremental:
+        do not list directories again whose modification time did not change since the last run,
+        their files and sizes are taken from the snapshot without touching them
+        (note: files that changed their size without being added, removed or renamed are not noticed this way)
+    :param workers:
+        number of threads listing directories concurrently, listing on network shares is latency bound
+    :param report_changes:
+        number of directories with the largest size change against the last run to print
+    :param report_largest:
+        number of largest directories to print
+    """
+    cwd = os.getcwd()
+    roots = [os.path.abspath(root) for root in roots] if roots else [cwd]
     csv.register_dialect('semicolon', delimiter=';', lineterminator='\n')
-    with open(csv_filename, "w", encoding="utf-8") as csv_file:
-        writer = csv.DictWriter(csv_file, ["path", "name", "isDir", "size", "depth"], dialect='semicolon')
-        writer.writeheader()
-        writer.writerows(dicts)
\ No newline at end of file
+    snapshot = TreeSnapshot(os.path.join(cwd, snapshot_filename))
+    # the directories complete in any order on the pool, sorted the file is the same between runs
+    rows = _SortedRows(key=lambda row: (row[0], row[1]))
+    scanner = _TreeScanner(rows, snapshot, incremental, workers, cwd, report_changes, report_largest)
+    try:
+        scanner.scan(roots)
+        snapshot.close()
+        with open(csv_filename, "w", encoding="utf-8") as csv_file:
+            writer = csv.writer(csv_file, dialect='semicolon')
+            writer.writerow(["path", "name", "isDir", "size", "depth"])
+            writer.writerows(rows.merged())
+    finally:
+        rows.close()
+
+    for root in scanner.roots:
+        print("total size:", _format_size(root.total), root.path)
+        if root.old:
+            print("change since last run:", _format_size(root.total - root.old[1], True))
+    if scanner.changes:
+        print("largest changes:")
+    for _, path, change, size in sorted(scanner.changes, reverse=True):
+        print(_format_size(change, True), path, _format_size(size))
+    if scanner.largest:
+        print("largest directories:")
+    for size, path in sorted(scanner.largest, reverse=True):
+        print(_format_size(size), path)
+
+
+class _DirNode:
+
+    def __init__(self, path: str, mtime: float, parent: "_DirNode" = None):
+        self.path = path
+        self.mtime = mtime
+        self.parent = parent
+        self.old: Optional[Tuple[float, int]] = None
+        self.total = 0
+        self.pending = 0
+        # not stored in the snapshot, so the next incremental run lists it again
+        self.failed = False
+
+
+class _TreeScanner:
+    """
+    lists directories on a thread pool, while the calling thread collects the rows and adds up the sizes
+    from the bottom up, so the rows and the new snapshot are only used by one thread
+    """
+
+    def __init__(self, rows: "_SortedRows", snapshot: "TreeSnapshot", incremental: bool, workers: int, cwd: str,
+                 report_changes: int, report_largest: int):
+        self.rows = rows
+        self.snapshot = snapshot
+        self.incremental = incremental
+        self.workers = workers
+        self.cwd = cwd
+        self.report_changes = report_changes
+        self.report_largest = report_largest
+        self.roots: List[_DirNode] = []
+        self.changes: List[Tuple[int, str, int, int]] = []
+        self.largest: List[Tuple[int, str]] = []
+        self._results = queue.Queue()
+
+    def scan(self, roots: List[str]):
+        with ThreadPoolExecutor(self.workers) as executor:
+            tasks = 0
+            for root in roots:
+                node = _DirNode(root, os.stat(root).st_mtime)
+                self.roots.append(node)
+                executor.submit(self._list, node)
+                tasks += 1
+            while tasks:
+                node, files, subdirs = self._results.get()
+                tasks -= 1
+                depth = len(node.path.split(os.sep))
+                for name, size in files:
+                    self.rows.add([node.path, name, False, size, depth + 1])
+                    node.total += size
+                if not node.failed:
+                    self.snapshot.add_files(node.path, files)
+                node.pending = len(subdirs)
+                for name, mtime in subdirs:
+                    executor.submit(self._list, _DirNode(os.path.join(node.path, name), mtime, node))
+                    tasks += 1
+                if not node.pending:
+                    self._finish(node)
+
+    def _list(self, node: _DirNode):
+        files = []
+        subdirs = []
+        try:
+            node.old = self.snapshot.get_dir(node.path)
+            if self.incremental and node.old and node.old[0] == node.mtime:
+                # an unchanged mtime means no entry was added, removed or renamed, only the subdirectories
+                # are stat-ed to decide whether they have to be listed
+                files = self.snapshot.get_files(node.path)
+                for name in self.snapshot.get_subdirs(node.path):
+                    try:
+                        subdirs.append((name, os.stat(os.path.join(node.path, name)).st_mtime))
+                    except OSError as e:
+                        print("can not read", os.path.join(node.path, name), e)
+                        node.failed = True
+            else:
+                for entry in walk_entries(node.path, max_depth=0, include_dirs=True):
+                    if entry.is_dir:
+                        subdirs.append((entry.name, entry.mtime))
+                    elif node.path == self.cwd and (entry.name == csv_filename or
+                                                    entry.name.startswith(snapshot_filename)):
+                        continue
+                    else:
+                        files.append((entry.name, entry.size))
+        except Exception as e:
+            print("can not scan", node.path, e)
+            node.failed = True
+        self._results.put((node, files, subdirs))
+
+    def _finish(self, node: _DirNode):
+        # write the completed directory and hand its size up as long as the parents are complete, too
+        while node:
+            if not node.failed:
+                self.snapshot.add_dir(node.path, node.parent.path if node.parent else "", node.mtime, node.total)
+            parent = node.parent
+            if not parent:
+                break
+            # a parent that is skipped next run would only know the subdirectories stored in the snapshot
+            parent.failed |= node.failed
+            dirpath, name = os.path.split(node.path)
+            self.rows.add([dirpath, name, True, node.total, len(dirpath.split(os.sep))])
+            self._report(node)
+            parent.total += node.total
+            parent.pending -= 1
+            if parent.pending:
+                break
+            node = parent
+
+    def _report(self, node: _DirNode):
+        if self.report_largest:
+            _push_limited(self.largest, (node.total, node.path), self.report_largest)
+        if self.report_changes and node.old and not node.old[1] == node.total:
+            change = (abs(node.total - node.old[1]), node.path, node.total - node.old[1], node.total)
+            _push_limited(self.changes, change, self.report_changes)
+
+
+class _SortedRows:
+    """
+    sorts rows with bounded memory: sorted runs of chunk_size rows are spilled to temporary csv files
+    and merged when the rows are written
+    """
+
+    def __init__(self, key: Callable[[list], tuple], chunk_size=100000):
+        self.key = key
+        self.chunk_size = chunk_size
+        self.chunk: List[list] = []
+        self.runs: List[str] = []
+
+    def add(self, row: list):
+        self.chunk.append(row)
+        if len(self.chunk) >= self.chunk_size:
+            self._spill()
+
+    def _spill(self):
+        fd, run = tempfile.mkstemp(prefix="treeSize", suffix=".run")
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as file:
+            csv.writer(file).writerows(sorted(self.chunk, key=self.key))
+        self.runs.append(run)
+        self.chunk = []
+
+    def merged(self) -> Iterator[list]:
+        self.chunk.sort(key=self.key)
+        files = [open(run, "r", encoding="utf-8", newline="") for run in self.runs]
+        try:
+            yield from heapq.merge(self.chunk, *[csv.reader(file) for file in files], key=self.key)
+        finally:
+            for file in files:
+                file.close()
+
+    def close(self):
+        for run in self.runs:
+            os.remove(run)
+        self.runs = []
+        self.chunk = []
+
+
+def _push_limited(heap: list, item: tuple, limit: int):
+    # keeps the limit largest items
+    if len(heap) < limit:
+        heapq.heappush(heap, item)
+    else:
+        heapq.heappushpop(heap, item)
+
+
+def _format_size(size: int, signed=False) -> str:
+    sign = ("+" if size >= 0 else "-") if signed else ""
+    size = abs(size)
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return "%s%d %s" % (sign, size, unit) if unit == "B" else "%s%.1f %s" % (sign, size, unit)
+        size /= 1024
+    return "%s%.1f TB" % (sign, size)
+
+
+class TreeSnapshot:
+    """
+    sizes and modification times of directories and the sizes of their files
+    the previous snapshot is only read (from any thread), the new one is written to a separate file
+    and replaces the previous one on close
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.has_old = os.path.isfile(filename)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._old_connections = []
+        if self.has_old:
+            try:
+                self._old().execute("SELECT path, parent, mtime, size FROM dirs LIMIT 1")
+            except sqlite3.Error as e:
+                print("ignoring old snapshot", filename, e)
+                self.has_old = False
+        if os.path.isfile(filename + ".new"):
+            os.remove(filename + ".new")
+        self.new = sqlite3.connect(filename + ".new")
+        self.new.execute("CREATE TABLE dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL, size INTEGER)")
+        self.new.execute("CREATE TABLE files (dirpath TEXT, name TEXT, size INTEGER)")
+
+    def _old(self) -> sqlite3.Connection:
+        # one read connection per thread, sqlite connections must not be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, check_same_thread=False)
+            self._local.connection = connection
+            with self._lock:
+                self._old_connections.append(connection)
+        return connection
+
+    def get_dir(self, path: str) -> Optional[Tuple[float, int]]:
+        if not self.has_old:
+            return None
+        return self._old().execute("SELECT mtime, size FROM dirs WHERE path = ?", (path,)).fetchone()
+
+    def get_subdirs(self, path: str) -> List[str]:
+        rows = self._old().execute("SELECT path FROM dirs WHERE parent = ?", (path,))
+        return [os.path.basename(row[0]) for row in rows]
+
+    def get_files(self, path: str) -> List[Tuple[str, int]]:
+        return self._old().execute("SELECT name, size FROM files WHERE dirpath = ?", (path,)).fetchall()
+
+    def add_dir(self, path: str, parent: str, mtime: float, size: int):
+        self.new.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)", (path, parent, mtime, size))
+
+    def add_files(self, path: str, files: List[Tuple[str, int]]):
+        self.new.executemany("INSERT INTO files VALUES (?, ?, ?)", [(path, name, size) for name, size in files])
+
+    def close(self):
+        self.new.execute("CREATE INDEX files_dirpath ON files (dirpath)")
+        self.new.execute("CREATE INDEX dirs_parent ON dirs (parent)")
+        self.new.commit()
+        self.new.close()
+        for connection in self._old_connections:
+            connection.close()
+        os.replace(self.filename + ".new", self.filename)
+